@@ -1,13 +1,17 @@
-import json
 import connexion
 
 from connexion import NoContent
-from geopy.geocoders import Nominatim
+from flask import current_app
 
 from .auth import auth, current_user, current_role
 from .models.user import User, InvalidUserInfo, USER_ROLE_ADMIN, USER_ROLE_USER
-from .models.community_resource import CommunityResource, NoExistingCommunityResource, InvalidCommunityResourceInfo
-from .models.community import Community
+from .models.community_resource import CommunityResource, NoExistingCommunityResource, InvalidCommunityResourceInfo, COMMUNITY_RESOURCE_DATA_VERSION
+from .models.community import Community, COMMUNITY_DATA_VERSION
+from .models.resource_cluster import ResourceCluster
+from .models.simplified_boundaries import select_tolerance
+from .geometry import InvalidPolygon
+from . import tiles
+from .response_cache import cached_response, response_caches
 from .validators import is_valid_password, is_valid_email, is_valid_phone_number, is_valid_community_resource_name
 from sqlalchemy import func
 from jwt import InvalidTokenError, ExpiredSignatureError
@@ -45,10 +49,11 @@ def put_user(body):
 
 
 def post_user(body):
-    user, email_hash = User.add_user(User.from_dict(body))
+    result = User.add_user(User.from_dict(body))
 
-    if user is None:
+    if result is None:
         return NoContent, 409
+    user, email_hash = result
 
     response_dict = user.to_dict()
     response_dict['activation_url'] = 'user/activate?email_hash=' + email_hash
@@ -66,30 +71,52 @@ def put_user_password(body):
 def get_user_token():
     return {"token": current_user().generate_auth_token()}, 201
 
+@cached_response(COMMUNITY_RESOURCE_DATA_VERSION)
 def get_communityresources(*args, **kwargs):
     longitude, latitude, radius = connexion.request.args.get("longitude"), connexion.request.args.get("latitude"), connexion.request.args.get("radius")
     polygon_string = connexion.request.args.get("polygon_string")
+    limit = connexion.request.args.get("limit")
+    cluster, zoom = connexion.request.args.get("cluster"), connexion.request.args.get("zoom")
+    ids = connexion.request.args.get("ids")
 
-    if longitude is not None and latitude is not None and radius is not None:
+    if ids is not None:
+        return get_communityresource_details(ids)
+    elif cluster is not None and zoom is None:
+        return NoContent, 400
+    elif cluster == "grid":
+        if longitude is not None and latitude is not None and radius is not None:
+            return [resource_cluster.to_dict() for resource_cluster in ResourceCluster.get_clusters_by_radius(zoom, longitude, latitude, radius)]
+        else:
+            try:
+                return [resource_cluster.to_dict() for resource_cluster in ResourceCluster.get_clusters_in_shape(zoom, polygon_string)]
+            except InvalidPolygon:
+                return NoContent, 400
+    elif longitude is not None and latitude is not None and radius is not None:
         return get_communityresource_list(longitude, latitude, radius)
+    elif longitude is not None and latitude is not None and limit is not None:
+        return get_communityresource_nearest(longitude, latitude, limit)
     else:
         return get_communityresource_in_shape(polygon_string)
 
 def get_communityresource_list(longitude, latitude, radius):
-    return [{
-        "community_resource_id": community_resource.community_resource_id,
-        "name": community_resource.name,
-        "address": community_resource.address,
-        "location": json.loads(location)
-    } for (community_resource, location) in CommunityResource.get_resources_by_radius(longitude=longitude, latitude=latitude, radius=radius)]
+    return json_response(CommunityResource.get_resources_by_radius_quantized(longitude=longitude, latitude=latitude, radius=radius))
+
+def get_communityresource_nearest(longitude, latitude, limit):
+    return json_response(CommunityResource.get_nearest_resources(longitude=longitude, latitude=latitude, limit=limit))
 
 def get_communityresource_in_shape(polygon_string):
-    return [{
-        "community_resource_id": community_resource.community_resource_id,
-        "name": community_resource.name,
-        "address": community_resource.address,
-        "location": json.loads(location)
-    } for (community_resource, location) in CommunityResource.get_resources_in_shape(polygon_string)]
+    try:
+        return json_response(CommunityResource.get_resources_in_shape(polygon_string))
+    except InvalidPolygon:
+        return NoContent, 400
+
+def json_response(body):
+    """Return a response with the given serialized JSON body, sent as is."""
+    return current_app.response_class(body, mimetype="application/json")
+
+def get_communityresource_details(ids):
+    community_resource_ids = [int(community_resource_id) for community_resource_id in ids.split(",")]
+    return json_response(CommunityResource.get_community_resources_by_ids(community_resource_ids))
 
 @auth.login_required
 def post_communityresource(body):
@@ -105,10 +132,13 @@ def post_communityresource(body):
     website = body["website"]
     image_uri = body["image_uri"]
 
-    longitude, latitude = CommunityResource.coordinates_from_address(address)
+    try:
+        coordinates = CommunityResource.coordinates_from_address(address)
+    except InvalidCommunityResourceInfo:
+        return NoContent, 400
 
     resource = CommunityResource(charity_number=charity_number, 
-                                 name=name, y=latitude, x=longitude,
+                                 name=name, coordinates=coordinates,
                                  contact_name=contact_name, email=email,
                                  phone_number=phone_number, address=address,
                                  website=website, image_uri=image_uri,
@@ -122,12 +152,13 @@ def post_communityresource(body):
     return NoContent, 201
 
 
+@cached_response(COMMUNITY_RESOURCE_DATA_VERSION)
 def get_communityresource_detail(community_resource_id):
     try:
         community_resource = CommunityResource.get_community_resource_by_id(community_resource_id)
     except NoExistingCommunityResource:
         return NoContent, 404
-    return community_resource, 200
+    return json_response(community_resource)
 
 
 @auth.login_required
@@ -135,7 +166,7 @@ def put_communityresource(community_resource_id, body):
     if current_role() != USER_ROLE_ADMIN:
         return NoContent, 403
     try:
-        (longitude, latitude) = CommunityResource.coordinates_from_address(body["address"])
+        (longitude, latitude) = CommunityResource.geocode_address(body["address"])
 
         CommunityResource.edit_community_resource(int(body["charity_number"]), body["name"], latitude, longitude, body["contact_name"], body["email"], body["phone_number"], body["address"], body["website"], body["image_uri"])
     except NoExistingCommunityResource:
@@ -145,16 +176,15 @@ def put_communityresource(community_resource_id, body):
     return NoContent, 200
 
 
-def get_all_communities():
-    return [{
-        "id": community.id,
-        "name": community.name,
-        "boundaries": json.loads(boundaries)
-    } for (community, boundaries) in Community.get_all_communities()]
+def get_all_communities(zoom=None, tolerance=None):
+    tolerance = select_tolerance(zoom=zoom, tolerance=tolerance)
+    return Community.get_all_communities_payload(tolerance).make_response(connexion.request)
 
 
-def get_community_surrounding(longitude, latitude):
-    res = Community.get_community_surrounding(longitude, latitude)
+@cached_response(COMMUNITY_DATA_VERSION)
+def get_community_surrounding(longitude, latitude, zoom=None, tolerance=None):
+    tolerance = select_tolerance(zoom=zoom, tolerance=tolerance)
+    res = Community.get_community_surrounding(longitude, latitude, tolerance)
     if res is None:
         return NoContent, 200
     else:
@@ -164,6 +194,20 @@ def get_community_surrounding(longitude, latitude):
             "boundaries": res[1]
         }, 200
 
+def get_tile(z, x, y):
+    if not tiles.is_valid_tile(z, x, y):
+        return NoContent, 404
+
+    return tiles.get_tile(z, x, y).make_response(connexion.request, max_age=current_app.config["TILE_MAX_AGE"])
+
+@auth.login_required
+def get_cache_stats():
+    if current_role() != USER_ROLE_ADMIN:
+        return NoContent, 403
+
+    return {name: cache.stats() for (name, cache) in response_caches.items()}
+
+
 def get_donations():
     """Retrieves most up to date donation version code
     
@@ -1,8 +1,20 @@
-from flask import g
+import hashlib
+import hmac
+import os
+
+from flask import g, current_app
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
 
+from .cache import LRUCache
 from .models.user import User
 
+CREDENTIAL_CACHE_SIZE = 1024
+
+# {<keyed hash of email and password>: <(user_id, role, token_version)>}
+_credential_cache = LRUCache(CREDENTIAL_CACHE_SIZE)
+# Never leaves this process, so cached keys cannot be attacked offline.
+_credential_key = os.urandom(32)
+
 basic_auth = HTTPBasicAuth()
 token_auth = HTTPTokenAuth()
 
@@ -10,30 +22,65 @@ auth = MultiAuth(basic_auth, token_auth)
 
 @basic_auth.verify_password
 def verify_password(email, password):
+    key = hmac.new(_credential_key, (email.lower() + "\0" + password).encode("utf-8"), hashlib.sha256).digest()
+
+    # Skip the password hash for recently verified credentials, unless the
+    # user's password or role has changed since.
+    cached = _credential_cache.get(key)
+    if cached is not None and cached[2] >= User.get_token_version(cached[0]):
+        g.current_user = None
+        g.current_user_id, g.current_role = cached[0], cached[1]
+        return True
+
     user = User.get_user_by_email(email)
 
     if not user or not user.verify_password(password):
         return False
 
+    ttl = current_app.config["CREDENTIAL_CACHE_TTL"]
+    if ttl:
+        _credential_cache.set(key, (user.user_id, user.role, user.token_version or 0), ttl)
+
     g.current_user = user
+    g.current_user_id = user.user_id
     g.current_role = user.role
 
     return True
 
 @token_auth.verify_token
 def verify_token(token):
-    user = User.get_user_by_token(token)
+    if current_app.config["TOKEN_AUTH_MODE"] == "database":
+        user = User.get_user_by_token(token)
+
+        if not user:
+            return False
 
-    if not user:
+        g.current_user = user
+        g.current_user_id = user.user_id
+        g.current_role = user.role
+
+        return True
+
+    # Trust the verified claims, and load the user only if a handler needs it.
+    claims = User.get_claims_by_token(token)
+
+    if not claims:
         return False
 
-    g.current_user = user
-    g.current_role = user.role
+    g.current_user = None
+    g.current_user_id = claims["user_id"]
+    g.current_role = claims["role"]
 
     return True
 
 def current_user():
+    if g.current_user is None:
+        g.current_user = User.query.get(g.current_user_id)
+
     return g.current_user
 
+def current_user_id():
+    return g.current_user_id
+
 def current_role():
     return g.current_role
@@ -0,0 +1,305 @@
+"""
+Cache
+====================================
+In-process caches, including caches for data which only changes when a
+dataset is written.
+"""
+import collections
+import gzip
+import hashlib
+import threading
+import time
+
+from flask import current_app, make_response
+
+from .models.data_version import DataVersion
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content encodings offered to clients, most preferred first.
+ENCODINGS = ("br", "gzip")
+
+# {<DataVersion name>: [<VersionedCache>]}
+_versioned_values = {}
+
+
+def invalidate(name):
+    """Mark the dataset with the given DataVersion name as changed, for this and
+    every other process.  The change is committed along with the caller's
+    session.
+    """
+    DataVersion.bump_version(name)
+
+    for value in _versioned_values.get(name, []):
+        value.clear()
+
+
+class LRUCache():
+    """A bounded, least recently used cache whose entries expire.
+
+    Counts hits and misses so that the cache's effectiveness can be reported.
+    """
+
+    def __init__(self, maxsize):
+        """
+        :param maxsize: The maximum number of entries to hold.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the unexpired value for the given key, or default."""
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[1] <= time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        """Hold the given value for the given key for ttl seconds."""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Discard the value for the given key, if any."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Discard every value."""
+        with self._lock:
+            self._entries.clear()
+
+
+class SingleFlight():
+    """Coalesces concurrent calls for the same key, so that only one of them
+    runs while the others wait for and share its result.
+
+    A waiting call which times out, or whose shared call raised, runs the
+    function itself, so coalescing never fails a call which would otherwise
+    have succeeded.  Results are shared between threads, so they must not be
+    modified.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self.timeouts = 0
+        # {<key>: <_Flight>}
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, timeout=None):
+        """Return the result of calling function, or of the concurrent call for
+        the same key which is already running.
+
+        :param timeout: The maximum seconds to wait for a concurrent call, or
+            None to wait until it finishes.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                flight.result = function()
+                flight.succeeded = True
+                return flight.result
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        if not flight.done.wait(timeout):
+            with self._lock:
+                self.timeouts += 1
+            return function()
+
+        if not flight.succeeded:
+            return function()
+        return flight.result
+
+
+class _Flight():
+    def __init__(self):
+        self.done = threading.Event()
+        self.succeeded = False
+        self.result = None
+
+
+class VersionedCache():
+    """A bounded, least recently used cache of values built from one or more
+    named datasets.  Every entry is discarded when the DataVersion of any of the
+    datasets changes.
+
+    The versions are checked at most once every DATA_VERSION_TTL seconds, so most
+    reads do not touch the database.  Writes to a dataset should call
+    invalidate with its name.
+
+    Concurrent misses for the same key build the value once, see SingleFlight.
+    """
+
+    def __init__(self, names, maxsize=1):
+        """
+        :param names: The DataVersion names of the datasets the values are built from.
+        :param maxsize: The maximum number of values to hold.
+        """
+        self.names = tuple(names)
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._versions = None
+        self._checked_at = None
+        # Incremented whenever the entries are discarded, so that values built
+        # from stale data are not stored.
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.flights = SingleFlight()
+
+        for name in self.names:
+            _versioned_values.setdefault(name, []).append(self)
+
+    def _check_versions(self):
+        now = time.monotonic()
+
+        if self._checked_at is not None and now - self._checked_at < current_app.config["DATA_VERSION_TTL"]:
+            return
+
+        versions = tuple(DataVersion.get_version(name) for name in self.names)
+        if versions != self._versions:
+            self._entries.clear()
+            self._generation += 1
+            self._versions = versions
+
+        self._checked_at = now
+
+    def get(self, key, build):
+        """Return the value for the given key, calling build to build it if it is
+        not held or the datasets have changed.  Values of None are not held.
+        """
+        with self._lock:
+            self._check_versions()
+
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+            self.misses += 1
+            generation = self._generation
+
+        value = self.flights.do((generation, key), build, current_app.config["SINGLE_FLIGHT_TIMEOUT"])
+
+        with self._lock:
+            if generation == self._generation and value is not None:
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def versions(self):
+        """The DataVersions of the datasets, as of the last check."""
+        with self._lock:
+            self._check_versions()
+            return self._versions
+
+    def clear(self):
+        """Discard the values held by this process."""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._versions = None
+            self._checked_at = None
+
+
+class VersionedValue(VersionedCache):
+    """A single value built from a named dataset, see VersionedCache."""
+
+    def __init__(self, name, build):
+        """
+        :param name: The DataVersion name of the dataset the value is built from.
+        :param build: A function of no arguments which builds the value.
+        """
+        VersionedCache.__init__(self, [name])
+        self.build = build
+
+    def get(self):
+        """Return the value, rebuilding it if the dataset has changed."""
+        return VersionedCache.get(self, None, self.build)
+
+
+class Payload():
+    """A serialized response body along with its compressed variants and a
+    strong ETag for each of them.
+    """
+
+    def __init__(self, body, mimetype="application/json"):
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()
+        self.variants = {"identity": body, "gzip": gzip.compress(body, 9)}
+
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(body)
+
+    def _variant_etag(self, encoding):
+        if encoding == "identity":
+            return self.etag
+        return self.etag + "-" + encoding
+
+    def make_response(self, request, max_age=None):
+        """Return a response for the given request, using the best encoding the
+        client accepts and answering 304 if the client's copy is current.
+
+        :param max_age: If given, the number of seconds shared caches may serve
+            the response without revalidating it.
+        """
+        encoding = "identity"
+        for accepted in ENCODINGS:
+            if accepted in self.variants and request.accept_encodings.quality(accepted) > 0:
+                encoding = accepted
+                break
+
+        etag = self._variant_etag(encoding)
+
+        if any(request.if_none_match.contains(self._variant_etag(variant)) for variant in self.variants):
+            response = make_response("", 304)
+        else:
+            response = make_response(self.variants[encoding], 200)
+            response.mimetype = self.mimetype
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        if max_age is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+        return response
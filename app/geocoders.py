@@ -0,0 +1,190 @@
+"""
+Geocoders
+====================================
+Interchangeable geocoding backends, selected by the GEOCODER configuration.
+"""
+import abc
+import hashlib
+import os
+import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import shapefile
+
+from flask import current_app
+from geopy.geocoders import Nominatim
+
+ADDRESS_SEPARATOR_RE = re.compile(r"[\s.,#]+")
+
+# Shapefile fields which hold a street address.
+GAZETTEER_ADDRESS_FIELDS = ("ADDRESS_FU", "Address")
+
+# (min longitude, min latitude, max longitude, max latitude) of Toronto.
+FAKE_GEOCODER_BOUNDS = (-79.64, 43.58, -79.12, 43.86)
+
+_geocoders = {}
+_geocoders_lock = threading.Lock()
+
+
+def normalize_address(address):
+    """Return the given address in lower case, with punctuation removed and
+    runs of whitespace collapsed, so that equivalent addresses compare equal.
+    """
+    return ADDRESS_SEPARATOR_RE.sub(" ", address.lower()).strip()
+
+
+class RateLimiter():
+    """Spaces out calls so that at most rate calls start each second, across
+    every thread using this limiter.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: The maximum number of calls per second, or 0 for no limit.
+        """
+        self.interval = 1.0 / rate if rate else 0
+        self._next_call = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call may start."""
+        if not self.interval:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_call)
+            self._next_call = start + self.interval
+
+        if start > now:
+            time.sleep(start - now)
+
+
+class Geocoder(metaclass=abc.ABCMeta):
+    """A geocoding backend.  Subclasses implement _geocode."""
+
+    def __init__(self, rate_limit=0, workers=1):
+        """
+        :param rate_limit: The maximum number of lookups per second, or 0 for no limit.
+        :param workers: The number of threads used by geocode_many.
+        """
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.workers = workers
+
+    def geocode(self, address):
+        """Return the (longitude, latitude) of the given address, or None if it
+        could not be geocoded.
+        """
+        self.rate_limiter.wait()
+        return self._geocode(address)
+
+    def geocode_many(self, addresses):
+        """Return a list of the (longitude, latitude), or None, of each of the
+        given addresses, looked up concurrently within the rate limit.
+        """
+        if len(addresses) <= 1:
+            return [self.geocode(address) for address in addresses]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self.geocode, addresses))
+
+    @abc.abstractmethod
+    def _geocode(self, address):
+        """Return the (longitude, latitude) of the given address, or None."""
+
+
+class NominatimGeocoder(Geocoder):
+    """Geocodes addresses with the OpenStreetMap Nominatim service."""
+
+    def __init__(self, **kwargs):
+        Geocoder.__init__(self, **kwargs)
+        self.nominatim = Nominatim()
+
+    def _geocode(self, address):
+        location = self.nominatim.geocode(address)
+
+        if location is None:
+            return None
+        return (location.longitude, location.latitude)
+
+
+class GazetteerGeocoder(Geocoder):
+    """Geocodes addresses offline, from the addresses and points in our own
+    shapefiles.  Only the street address, before the first comma, is matched.
+    """
+
+    def __init__(self, paths, **kwargs):
+        """
+        :param paths: Paths to point shapefiles with an address field.
+        """
+        Geocoder.__init__(self, **kwargs)
+        self.gazetteer = {}
+
+        for path in paths:
+            if not os.path.exists(path):
+                print(path + " does not exist")
+                continue
+
+            sf = shapefile.Reader(path)
+            field_names = [field[0] for field in sf.fields[1:]]
+            address_fields = [field for field in GAZETTEER_ADDRESS_FIELDS if field in field_names]
+            if not address_fields:
+                raise ValueError("{} has none of the address fields {}".format(path, ", ".join(GAZETTEER_ADDRESS_FIELDS)))
+            address_index = field_names.index(address_fields[0])
+
+            for shapeRecord in sf.iterShapeRecords():
+                longitude, latitude = shapeRecord.shape.points[0]
+                self.gazetteer[GazetteerGeocoder._street_address(shapeRecord.record[address_index])] = (longitude, latitude)
+
+    @staticmethod
+    def _street_address(address):
+        return normalize_address(address.split(",")[0])
+
+    def _geocode(self, address):
+        return self.gazetteer.get(GazetteerGeocoder._street_address(address))
+
+
+class FakeGeocoder(Geocoder):
+    """Geocodes every non-empty address to a point in Toronto derived from a
+    hash of the normalized address, for tests and benchmarks.
+    """
+
+    def _geocode(self, address):
+        key = normalize_address(address)
+
+        if not key:
+            return None
+
+        digest = hashlib.sha256(key.encode("utf-8")).digest()
+        x = int.from_bytes(digest[0:4], "big") / 2 ** 32
+        y = int.from_bytes(digest[4:8], "big") / 2 ** 32
+        min_longitude, min_latitude, max_longitude, max_latitude = FAKE_GEOCODER_BOUNDS
+
+        return (min_longitude + (max_longitude - min_longitude) * x,
+                min_latitude + (max_latitude - min_latitude) * y)
+
+
+def get_geocoder():
+    """Return the geocoder selected by the GEOCODER configuration, shared by
+    every thread in this process.
+    """
+    config = current_app.config
+    name = config["GEOCODER"]
+
+    with _geocoders_lock:
+        if name not in _geocoders:
+            kwargs = {"rate_limit": config["GEOCODER_RATE_LIMIT"], "workers": config["GEOCODER_WORKERS"]}
+
+            if name == "nominatim":
+                _geocoders[name] = NominatimGeocoder(**kwargs)
+            elif name == "gazetteer":
+                _geocoders[name] = GazetteerGeocoder(config["GEOCODER_GAZETTEER_PATHS"], **kwargs)
+            elif name == "fake":
+                _geocoders[name] = FakeGeocoder(**kwargs)
+            else:
+                raise ValueError("Unknown geocoder: " + name)
+
+        return _geocoders[name]
@@ -0,0 +1,370 @@
+"""
+Geometry
+====================================
+Geometry helpers, both for building spatial SQL expressions and for answering
+spatial queries in memory without a database round trip.
+"""
+import array
+import itertools
+import math
+import operator
+import re
+import struct
+import sys
+
+from flask import current_app
+from sqlalchemy import func
+
+NODE_CAPACITY = 8
+METERS_PER_KM = 1000
+
+WKB_POINT = 1
+WKB_POLYGON = 3
+WKB_MULTIPOLYGON = 6
+EWKB_SRID_FLAG = 0x20000000
+WKB_LITTLE_ENDIAN = 1
+
+# Generous characters of WKT per vertex, for rejecting oversized text before
+# parsing it.
+WKT_CHARS_PER_VERTEX = 64
+WKT_POLYGON_RE = re.compile(r"^\s*(POLYGON|MULTIPOLYGON)\s*(\(.*\))\s*$", re.IGNORECASE | re.DOTALL)
+WKT_TOKEN_RE = re.compile(r"[(),]|[^\s(),]+")
+
+
+class InvalidPolygon(ValueError):
+    """A polygon given by a client is malformed or too costly to search."""
+    pass
+
+
+def geography(geometry):
+    """Return the given SQL geometry expression as a geography.
+
+    Coordinates are stored as (latitude, longitude), so the axes are flipped
+    into the (longitude, latitude) order PostGIS expects before the cast.
+    """
+    return func.geography(func.ST_FlipCoordinates(geometry))
+
+
+def grid_cell(x, y, size):
+    """Return the (column, row) of the square grid cell of the given size which
+    contains the point (x, y).
+    """
+    return (int(math.floor(x / size)), int(math.floor(y / size)))
+
+
+def cell_center(cell, size):
+    """Return the (x, y) center of the given grid cell."""
+    return ((cell[0] + 0.5) * size, (cell[1] + 0.5) * size)
+
+
+def quantize_radius(radius, buckets):
+    """Return the smallest of the given ascending radius buckets which is at
+    least the given radius, or None if the radius is larger than every bucket.
+    """
+    for bucket in buckets:
+        if radius <= bucket:
+            return bucket
+    return None
+
+
+def bounding_box(points):
+    """Return the (min_x, min_y, max_x, max_y) bounding box of the given points."""
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def box_contains(box, x, y):
+    """Return True if the point (x, y) is inside or on the given bounding box."""
+    return box[0] <= x <= box[2] and box[1] <= y <= box[3]
+
+
+def merge_boxes(boxes):
+    """Return the bounding box enclosing all of the given bounding boxes."""
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+class PreparedMultiPolygon():
+    """A MultiPolygon prepared for repeated point-in-polygon tests.
+
+    Every ring is flattened into a list of edges and given its own bounding box
+    so that a point lookup only walks the edges of the rings it could be in.
+    """
+
+    def __init__(self, coordinates):
+        """Prepare the given GeoJSON MultiPolygon coordinates."""
+        self.polygons = []
+
+        for polygon in coordinates:
+            rings = []
+            for ring in polygon:
+                edges = [(ring[i][0], ring[i][1], ring[i + 1][0], ring[i + 1][1])
+                         for i in range(len(ring) - 1)]
+                rings.append((bounding_box(ring), edges))
+
+            self.polygons.append((rings[0][0], rings))
+
+        self.box = merge_boxes([box for (box, _) in self.polygons])
+
+    def contains(self, x, y):
+        """Return True if the point (x, y) is inside this MultiPolygon.
+
+        Uses the even-odd rule over every ring of a polygon, so points inside a
+        hole are not contained.
+        """
+        for (box, rings) in self.polygons:
+            if not box_contains(box, x, y):
+                continue
+
+            inside = False
+            for (ring_box, edges) in rings:
+                if not box_contains(ring_box, x, y):
+                    continue
+                for (x1, y1, x2, y2) in edges:
+                    if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+                        inside = not inside
+
+            if inside:
+                return True
+
+        return False
+
+
+class BoundingBoxTree():
+    """A static, bulk loaded tree of bounding boxes.
+
+    Items are packed into nodes of at most ``NODE_CAPACITY`` entries using the
+    Sort-Tile-Recursive algorithm, so a point lookup only visits the branches
+    whose bounding boxes contain the point.
+    """
+
+    def __init__(self, items):
+        """Build a tree over a list of (bounding box, value) pairs."""
+        self.size = len(items)
+        level = [(box, value, None) for (box, value) in items]
+
+        while len(level) > NODE_CAPACITY:
+            level = [(merge_boxes([entry[0] for entry in node]), None, node)
+                     for node in BoundingBoxTree._pack(level)]
+
+        self.root = level
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def _pack(entries):
+        """Group the given entries into nodes of neighbouring bounding boxes."""
+        node_count = -(-len(entries) // NODE_CAPACITY)
+        slice_count = max(1, int(node_count ** 0.5))
+        slice_size = NODE_CAPACITY * -(-node_count // slice_count)
+
+        entries = sorted(entries, key=lambda entry: entry[0][0] + entry[0][2])
+        nodes = []
+        for i in range(0, len(entries), slice_size):
+            vertical_slice = sorted(entries[i:i + slice_size], key=lambda entry: entry[0][1] + entry[0][3])
+            for j in range(0, len(vertical_slice), NODE_CAPACITY):
+                nodes.append(vertical_slice[j:j + NODE_CAPACITY])
+
+        return nodes
+
+    def query_point(self, x, y):
+        """Yield the values whose bounding boxes contain the point (x, y)."""
+        stack = [self.root]
+
+        while stack:
+            for (box, value, children) in stack.pop():
+                if not box_contains(box, x, y):
+                    continue
+                if children is None:
+                    yield value
+                else:
+                    stack.append(children)
+
+
+def coordinate_buffer(points):
+    """Return the given (x, y) points as a flat array of doubles."""
+    return array.array("d", itertools.chain.from_iterable(points))
+
+
+def swap_axes(buffer):
+    """Return a copy of the given coordinate buffer with x and y swapped."""
+    swapped = array.array("d", buffer)
+    swapped[0::2] = buffer[1::2]
+    swapped[1::2] = buffer[0::2]
+    return swapped
+
+
+def signed_area(ring):
+    """Return the signed area of the given closed ring coordinate buffer, which
+    is negative when the ring is clockwise.
+    """
+    xs = ring[0::2]
+    ys = ring[1::2]
+    return (sum(map(operator.mul, xs[:-1], ys[1:])) - sum(map(operator.mul, xs[1:], ys[:-1]))) / 2
+
+
+def shapefile_polygons(buffer, parts):
+    """Split the coordinate buffer of a shapefile polygon into a list of
+    polygons, each a list of ring buffers with the outer ring first.
+
+    Shapefiles store outer rings clockwise and holes counter-clockwise, with
+    each hole following its outer ring.
+    """
+    offsets = [part * 2 for part in parts] + [len(buffer)]
+    polygons = []
+
+    for (start, end) in zip(offsets, offsets[1:]):
+        ring = buffer[start:end]
+        if not polygons or signed_area(ring) <= 0:
+            polygons.append([ring])
+        else:
+            polygons[-1].append(ring)
+
+    return polygons
+
+
+def point_ewkb(buffer, srid):
+    """Return the EWKB of the point in the given coordinate buffer."""
+    return _ewkb_header(WKB_POINT, srid) + _wkb_doubles(buffer)
+
+
+def multipolygon_ewkb(polygons, srid):
+    """Return the EWKB of a multipolygon from a list of polygons, each a list
+    of ring coordinate buffers with the outer ring first.
+    """
+    chunks = [_ewkb_header(WKB_MULTIPOLYGON, srid), struct.pack("<I", len(polygons))]
+
+    for polygon in polygons:
+        chunks.append(struct.pack("<BII", WKB_LITTLE_ENDIAN, WKB_POLYGON, len(polygon)))
+        for ring in polygon:
+            chunks.append(struct.pack("<I", len(ring) // 2))
+            chunks.append(_wkb_doubles(ring))
+
+    return b"".join(chunks)
+
+
+def parse_wkt_polygon(polygon_string, max_vertices):
+    """Return the polygons of the given WKT POLYGON or MULTIPOLYGON as a list of
+    polygons, each a list of ring coordinate buffers with the outer ring first.
+
+    Raises InvalidPolygon if the text is malformed, a ring is not closed, or it
+    has more than max_vertices vertices.
+    """
+    if not isinstance(polygon_string, str):
+        raise InvalidPolygon("No polygon given")
+    if len(polygon_string) > (max_vertices + 1) * WKT_CHARS_PER_VERTEX:
+        raise InvalidPolygon("Polygon has too many vertices")
+
+    match = WKT_POLYGON_RE.match(polygon_string)
+    if match is None:
+        raise InvalidPolygon("Not a POLYGON or MULTIPOLYGON")
+
+    multi = match.group(1).upper() == "MULTIPOLYGON"
+    tokens = WKT_TOKEN_RE.findall(match.group(2))
+    items, index = _parse_wkt_list(tokens, 0, 3 if multi else 2)
+    if index != len(tokens):
+        raise InvalidPolygon("Unexpected text after the polygon")
+
+    polygons = []
+    vertices = 0
+    for rings in (items if multi else [items]):
+        polygon = []
+        for ring in rings:
+            buffer = coordinate_buffer(_parse_wkt_point(point) for point in ring)
+            vertices += len(ring)
+            if vertices > max_vertices:
+                raise InvalidPolygon("Polygon has too many vertices")
+            if len(ring) < 4 or buffer[:2] != buffer[-2:]:
+                raise InvalidPolygon("Polygon rings must be closed and have at least 4 points")
+            polygon.append(buffer)
+        polygons.append(polygon)
+
+    return polygons
+
+
+def _parse_wkt_list(tokens, index, depth):
+    """Parse the parenthesized, comma separated list starting at tokens[index],
+    nested depth lists deep, whose innermost items are lists of number tokens.
+    Returns the list and the index of the token following it.
+    """
+    if index >= len(tokens) or tokens[index] != "(":
+        raise InvalidPolygon("Expected (")
+    index += 1
+
+    items = []
+    while True:
+        if depth > 1:
+            item, index = _parse_wkt_list(tokens, index, depth - 1)
+        else:
+            start = index
+            while index < len(tokens) and tokens[index] not in ("(", ")", ","):
+                index += 1
+            item = tokens[start:index]
+        items.append(item)
+
+        if index >= len(tokens):
+            raise InvalidPolygon("Expected )")
+        if tokens[index] == ")":
+            return items, index + 1
+        if tokens[index] != ",":
+            raise InvalidPolygon("Expected , or )")
+        index += 1
+
+
+def _parse_wkt_point(tokens):
+    if len(tokens) != 2:
+        raise InvalidPolygon("Points must have 2 coordinates")
+    try:
+        point = (float(tokens[0]), float(tokens[1]))
+    except ValueError:
+        raise InvalidPolygon("Coordinates must be numbers")
+    if not all(map(math.isfinite, point)):
+        raise InvalidPolygon("Coordinates must be finite")
+    return point
+
+
+def polygons_area(polygons):
+    """Return the area of the given list of polygons, each a list of ring
+    coordinate buffers with the outer ring first.
+    """
+    return sum(abs(signed_area(polygon[0])) - sum(abs(signed_area(hole)) for hole in polygon[1:]) for polygon in polygons)
+
+
+def polygons_bounding_box(polygons):
+    """Return the bounding box of the outer rings of the given polygons."""
+    return merge_boxes([(min(ring[0::2]), min(ring[1::2]), max(ring[0::2]), max(ring[1::2]))
+                        for ring in (polygon[0] for polygon in polygons)])
+
+
+def search_shape(polygon_string, limit_area=True):
+    """Parse and check a WKT polygon given by a client, and return SQL
+    expressions of the polygon and of its bounding box, for searching within it.
+
+    Raises InvalidPolygon if it is malformed, has more than POLYGON_MAX_VERTICES
+    vertices or, if limit_area is True, covers more than POLYGON_MAX_AREA square
+    degrees.  Polygons with more than POLYGON_SIMPLIFY_VERTICES vertices are
+    simplified to POLYGON_SIMPLIFY_TOLERANCE degrees.
+    """
+    config = current_app.config
+    polygons = parse_wkt_polygon(polygon_string, config["POLYGON_MAX_VERTICES"])
+    if limit_area and polygons_area(polygons) > config["POLYGON_MAX_AREA"]:
+        raise InvalidPolygon("Polygon is too large")
+
+    shape = func.ST_GeomFromEWKB(multipolygon_ewkb(polygons, 4326))
+    if sum(len(ring) // 2 for polygon in polygons for ring in polygon) > config["POLYGON_SIMPLIFY_VERTICES"]:
+        shape = func.ST_SimplifyPreserveTopology(shape, config["POLYGON_SIMPLIFY_TOLERANCE"])
+
+    return shape, func.ST_MakeEnvelope(*(polygons_bounding_box(polygons) + (4326,)))
+
+
+def _ewkb_header(geometry_type, srid):
+    return struct.pack("<BII", WKB_LITTLE_ENDIAN, geometry_type | EWKB_SRID_FLAG, srid)
+
+
+def _wkb_doubles(buffer):
+    if sys.byteorder != "little":
+        buffer = array.array("d", buffer)
+        buffer.byteswap()
+    return buffer.tobytes()
@@ -0,0 +1,271 @@
+"""
+Ingest
+====================================
+Helpers for bulk loading datasets into the database.
+"""
+import collections
+import hashlib
+import itertools
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import shapefile
+
+from flask import current_app
+from geoalchemy2 import Geometry
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from . import db
+from .models.source_file import SourceFile
+from .models.source_record import SourceRecord
+
+INGEST_BATCH_SIZE = 500
+CHECKSUM_CHUNK_SIZE = 1 << 16
+
+# The files making up a shapefile, which are hashed together.
+SHAPEFILE_EXTENSIONS = (".shp", ".shx", ".dbf")
+
+# The keys of the rows written and deleted by an ingest.
+IngestResult = collections.namedtuple("IngestResult", ["upserted", "deleted"])
+
+
+def file_checksum(path):
+    """Return the SHA-256 hex digest of the shapefile with the given path and
+    its sidecar files, or None if it does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+
+    digest = hashlib.sha256()
+    root = os.path.splitext(path)[0]
+    for extension in SHAPEFILE_EXTENSIONS:
+        if not os.path.exists(root + extension):
+            continue
+        with open(root + extension, "rb") as f:
+            for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def record_checksum(row):
+    """Return the SHA-256 hex digest of the given dict of column values."""
+    return hashlib.sha256(repr(sorted(row.items())).encode("utf-8")).hexdigest()
+
+
+def read_shapefile(path, parse, batch_size=INGEST_BATCH_SIZE, workers=0, timer=None):
+    """Yield the row parsed from each record of the shapefile with the given
+    path, streaming the file so that at most batch_size records are held in
+    memory at once.
+
+    :param parse: A function taking a dict of {<field>: <value>} and a shape,
+        and returning a dict of column values.  It must be a module level
+        function when workers are used.
+    :param workers: The number of processes parsing records, or 0 to parse them
+        in this process.
+    :param timer: An IngestTimer to report progress to after every batch.
+    """
+    if not os.path.exists(path):
+        print(path + " does not exist")
+        return
+
+    sf = shapefile.Reader(path)
+    field_names = [field[0] for field in sf.fields[1:]]
+    records = ((dict(zip(field_names, shapeRecord.record)), shapeRecord.shape) for shapeRecord in sf.iterShapeRecords())
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+    try:
+        for batch in _batches(records, batch_size):
+            if executor is None:
+                rows = [parse(record, shape) for (record, shape) in batch]
+            else:
+                rows = executor.map(parse, *zip(*batch), chunksize=max(1, len(batch) // workers))
+
+            for row in rows:
+                yield row
+
+            if timer is not None:
+                timer.progress(len(batch))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def ingest_dataset(dataset, table, key, paths, parse, force=False):
+    """Bring the given table up to date with the dataset read from the given
+    shapefiles, in the caller's transaction.
+
+    The dataset is skipped if none of its files changed since the last ingest.
+    Otherwise only the rows whose content changed are written, and the rows
+    from the last ingest which are no longer in the dataset are deleted.  Rows
+    are never deleted while one of the files is missing.
+
+    Records are read and written in batches of INGEST_BATCH_SIZE, and parsed
+    by INGEST_WORKERS processes.
+
+    :param dataset: The name the dataset's record checksums are stored under.
+    :param table: The Table to write to.
+    :param key: The name of the table's primary key column.
+    :param paths: The paths of the dataset's shapefiles.
+    :param parse: The function passed to read_shapefile.
+    :param force: Read the files even if they have not changed.
+    :returns: An IngestResult, or None if the dataset was skipped.
+    """
+    timer = IngestTimer(dataset)
+    checksums = {path: file_checksum(path) for path in paths}
+    present = {path: checksum for (path, checksum) in checksums.items() if checksum is not None}
+
+    if not force and SourceFile.get_checksums(list(present)) == present:
+        print("{}: unchanged".format(dataset))
+        return None
+
+    batch_size = current_app.config["INGEST_BATCH_SIZE"]
+    workers = current_app.config["INGEST_WORKERS"]
+    rows = itertools.chain.from_iterable(
+        read_shapefile(path, parse, batch_size, workers, timer) for path in paths)
+
+    result = sync_records(dataset, table, key, rows, delete_missing=len(present) == len(paths), batch_size=batch_size)
+    SourceFile.set_checksums(present)
+
+    timer.report(len(result.upserted))
+    if result.deleted:
+        print("{}: {} rows deleted".format(dataset, len(result.deleted)))
+
+    return result
+
+
+def sync_records(dataset, table, key, rows, delete_missing=True, batch_size=INGEST_BATCH_SIZE):
+    """Write the given rows of a dataset whose content changed since the last
+    ingest, and delete the rows from the last ingest which are not given, in
+    the caller's transaction.
+
+    When several rows share a key, the first one is used and the rest are
+    skipped.
+
+    :returns: An IngestResult.
+    """
+    stored = SourceRecord.get_checksums(dataset)
+    seen = set()
+    checksums = {}
+    upserted = []
+
+    def changed_rows():
+        for row in rows:
+            if row[key] in seen:
+                continue
+            seen.add(row[key])
+
+            checksum = record_checksum(row)
+            if stored.get(str(row[key])) != checksum:
+                checksums[str(row[key])] = checksum
+                upserted.append(row[key])
+                yield row
+
+    bulk_upsert(table, changed_rows(), key, batch_size)
+    SourceRecord.set_checksums(dataset, checksums)
+
+    deleted = []
+    if delete_missing:
+        vanished = set(stored) - {str(row_key) for row_key in seen}
+        deleted = [table.c[key].type.python_type(row_key) for row_key in vanished]
+        if deleted:
+            db.session.execute(table.delete().where(table.c[key].in_(deleted)))
+        SourceRecord.delete_keys(dataset, list(vanished))
+
+    return IngestResult(upserted, deleted)
+
+
+def bulk_upsert(table, rows, key, batch_size=INGEST_BATCH_SIZE):
+    """Insert the given rows into the given table, updating rows whose key
+    already exists, with one multi-row INSERT ... ON CONFLICT DO UPDATE per
+    batch.  The rows are written in the caller's transaction.  Values of
+    geometry columns are given as EWKB.
+
+    When several rows share a key, the first one is written and the rest are
+    skipped.
+
+    :param table: The Table to write to.
+    :param rows: An iterable of dicts of column values.
+    :param key: The name of the table's primary key column.
+    :param batch_size: The number of rows per INSERT statement.
+    :returns: The number of rows written.
+    """
+    seen = set()
+    batch = []
+    count = 0
+
+    for row in rows:
+        if row[key] in seen:
+            continue
+        seen.add(row[key])
+
+        batch.append(row)
+        if len(batch) >= batch_size:
+            count += _upsert_batch(table, batch, key)
+            batch = []
+
+    if batch:
+        count += _upsert_batch(table, batch, key)
+
+    return count
+
+
+def _upsert_batch(table, batch, key):
+    geometry_columns = [column.name for column in table.columns if isinstance(column.type, Geometry)]
+    if geometry_columns:
+        batch = [_with_geometries(row, geometry_columns) for row in batch]
+
+    statement = insert(table).values(batch)
+    statement = statement.on_conflict_do_update(
+        index_elements=[key],
+        set_={name: statement.excluded[name] for name in batch[0] if name != key})
+
+    db.session.execute(statement)
+    return len(batch)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _with_geometries(row, geometry_columns):
+    row = dict(row)
+    for name in geometry_columns:
+        if name in row:
+            row[name] = func.ST_GeomFromEWKB(row[name])
+    return row
+
+
+class IngestTimer():
+    """Measures and reports the throughput of an ingest."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.monotonic()
+        self.read = 0
+
+    def progress(self, count):
+        """Record that count more rows were read, and print the running total
+        and the rate they were read at.
+        """
+        self.read += count
+        print("{}: {} rows read ({:.0f} rows/s)".format(self.name, self.read, self.read / self.elapsed()))
+
+    def report(self, count):
+        """Print the number of rows written since this timer was created, and
+        the rate they were written at.
+        """
+        seconds = self.elapsed()
+        print("{}: {} rows written in {:.2f}s ({:.0f} rows/s)".format(self.name, count, seconds, count / seconds))
+
+    def elapsed(self):
+        """Return the seconds since this timer was created."""
+        return max(time.monotonic() - self.start, 1e-6)
@@ -0,0 +1,174 @@
+"""
+Mailer
+====================================
+Sends the emails queued in the outbox over a pool of SMTP connections, off the
+request path.
+"""
+import collections
+import queue
+import smtplib
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+from flask import current_app
+
+from . import db
+from .models.outbox_email import OutboxEmail
+
+# Number of emails sent, retried and given up on by this process, keyed by
+# "sent", "retried" and "failed".
+mail_stats = collections.Counter()
+
+
+class SMTPPool():
+    """A bounded pool of SMTP connections which are reused across emails."""
+
+    def __init__(self, host, port, size=1, use_tls=False, username=None, password=None, timeout=30):
+        """
+        :param size: The maximum number of open connections.
+        """
+        self.host = host
+        self.port = port
+        self.size = size
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @staticmethod
+    def from_config(config):
+        """Return a pool for the SMTP server given by the MAIL_* configuration."""
+        return SMTPPool(
+            config["MAIL_SERVER"],
+            config["MAIL_PORT"],
+            size=config["MAIL_SMTP_POOL_SIZE"],
+            use_tls=config["MAIL_USE_TLS"],
+            username=config["MAIL_USERNAME"],
+            password=config["MAIL_PASSWORD"])
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password)
+        return connection
+
+    def send(self, message):
+        """Send the given EmailMessage, reconnecting once if an idle connection
+        was closed by the server.
+        """
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+
+            try:
+                try:
+                    connection.send_message(message)
+                except smtplib.SMTPServerDisconnected:
+                    connection = self._connect()
+                    connection.send_message(message)
+            except Exception:
+                _quit(connection)
+                raise
+
+            self._idle.put(connection)
+
+    def close(self):
+        """Close every idle connection."""
+        while True:
+            try:
+                _quit(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def _quit(connection):
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, OSError):
+        connection.close()
+
+
+def retry_delay(attempts, backoff, max_backoff):
+    """Return the seconds to wait before retrying an email which has failed the
+    given number of times, doubling with every attempt.
+    """
+    return min(backoff * 2 ** (attempts - 1), max_backoff)
+
+
+def build_message(email, sender):
+    """Return an EmailMessage for the given OutboxEmail."""
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = email.recipient
+    message["Subject"] = email.subject
+    message.set_content(email.body)
+    return message
+
+
+def send_due(pool):
+    """Send the emails which are due, in batches of MAIL_BATCH_SIZE, until none
+    are left.  Emails which fail are retried with exponential backoff, up to
+    MAIL_MAX_ATTEMPTS times.
+
+    :returns: The number of emails attempted.
+    """
+    config = current_app.config
+    total = 0
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        while True:
+            emails = OutboxEmail.claim_due(config["MAIL_BATCH_SIZE"])
+            if not emails:
+                db.session.commit()
+                return total
+
+            messages = [build_message(email, config["MAIL_SENDER"]) for email in emails]
+            futures = [executor.submit(pool.send, message) for message in messages]
+
+            for (email, future) in zip(emails, futures):
+                error = future.exception()
+                if error is None:
+                    email.mark_sent()
+                    mail_stats["sent"] += 1
+                elif email.attempts + 1 >= config["MAIL_MAX_ATTEMPTS"]:
+                    email.mark_failed(repr(error))
+                    mail_stats["failed"] += 1
+                else:
+                    email.mark_failed(repr(error), retry_delay(
+                        email.attempts + 1, config["MAIL_RETRY_BACKOFF"], config["MAIL_RETRY_BACKOFF_MAX"]))
+                    mail_stats["retried"] += 1
+
+            db.session.commit()
+            total += len(emails)
+
+
+def run_worker(once=False):
+    """Send queued emails until interrupted, polling the outbox every
+    MAIL_POLL_INTERVAL seconds, and print the queue depth after every pass.
+
+    :param once: Return after one pass instead of polling.
+    """
+    pool = SMTPPool.from_config(current_app.config)
+
+    try:
+        while True:
+            if send_due(pool):
+                depth, oldest = OutboxEmail.queue_depth()
+                db.session.commit()
+                print("mail: {} sent, {} retried, {} failed, {} queued".format(
+                    mail_stats["sent"], mail_stats["retried"], mail_stats["failed"], depth))
+
+            if once:
+                return
+            time.sleep(current_app.config["MAIL_POLL_INTERVAL"])
+    finally:
+        pool.close()
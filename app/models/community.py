@@ -3,14 +3,19 @@ Community
 ====================================
 The Community module
 """
-import os
-import shapefile
-import pygeoif
+import json
+import functools
 
 from .. import db
-from geoalchemy2 import WKTElement
+from ..cache import Payload, VersionedValue, invalidate
+from ..geometry import BoundingBoxTree, PreparedMultiPolygon, coordinate_buffer, swap_axes, shapefile_polygons, multipolygon_ewkb
+from ..ingest import ingest_dataset
+from .simplified_boundaries import SimplifiedBoundaries, SIMPLIFICATION_TIERS, FULL_RESOLUTION
 from geoalchemy2 import Geometry
-from sqlalchemy import Column, String, Integer, func
+from sqlalchemy import Column, String, Integer, and_, func
+
+COMMUNITY_DATA_VERSION = "community"
+
 
 class Community(db.Model):
     __tablename__ = "community"
@@ -33,24 +38,85 @@ class Community(db.Model):
         return cls(**data)
 
     @classmethod
-    def get_all_communities (cls):
+    def get_all_communities (cls, tolerance=FULL_RESOLUTION):
         """Query the database and return a list of all Communities with their id, 
-        name and boundaries in GeoJSON format.
+        name and boundaries in GeoJSON format.  Boundaries are simplified to the
+        given stored tolerance, see select_tolerance, or sent at full resolution
+        if they have not been simplified.
         """
-        return db.session.query(Community, func.ST_AsGeoJSON(Community.boundaries)).all()
+        if tolerance == FULL_RESOLUTION:
+            return db.session.query(Community, func.ST_AsGeoJSON(Community.boundaries)).all()
+
+        return db.session.query(
+                Community, func.ST_AsGeoJSON(func.coalesce(SimplifiedBoundaries.boundaries, Community.boundaries))
+            ).outerjoin(
+                SimplifiedBoundaries, and_(
+                    SimplifiedBoundaries.community_id == Community.id,
+                    SimplifiedBoundaries.tolerance == tolerance)
+            ).all()
 
     @classmethod
-    def get_community_surrounding(cls, longitude, latitude):
+    def get_community_surrounding(cls, longitude, latitude, tolerance=FULL_RESOLUTION):
         """Get a Community with boundaries surrounding a given point specified
-        by longitude and latitude.  Returns the Community id, name and boundaries.
+        by longitude and latitude.  Returns the Community id, name and boundaries
+        simplified to the given stored tolerance, or at full resolution if they
+        have not been simplified.
+
+        The lookup is answered from the in-memory Community index.
         """
-        return db.session.query(
-                Community, func.ST_AsGeoJSON(Community.boundaries)
-            ).filter(
-                func.ST_Contains(
-                    Community.boundaries, 
-                    WKTElement("POINT({} {})".format(longitude, latitude), 4326))
-            ).first()
+        x, y = float(longitude), float(latitude)
+
+        for (community, boundaries, polygon) in cls.get_community_index().query_point(x, y):
+            if polygon.contains(x, y):
+                return community, boundaries.get(tolerance, boundaries[FULL_RESOLUTION])
+
+        return None
+
+    @classmethod
+    def get_community_index(cls):
+        """Return a bounding box tree of (Community, {<tolerance>: <GeoJSON
+        boundaries>}, prepared boundaries) entries for every Community, held in
+        memory until the Community data changes.
+        """
+        return _community_index.get()
+
+    @classmethod
+    def _build_community_index(cls):
+        """Load every Community from the database into a bounding box tree."""
+        simplified = {}
+        for (community_id, tolerance, boundaries) in db.session.query(
+                SimplifiedBoundaries.community_id, SimplifiedBoundaries.tolerance,
+                func.ST_AsGeoJSON(SimplifiedBoundaries.boundaries)).all():
+            simplified.setdefault(community_id, {})[tolerance] = boundaries
+
+        entries = []
+        for (community_id, name, boundaries) in db.session.query(
+                Community.id, Community.name, func.ST_AsGeoJSON(Community.boundaries)).all():
+            polygon = PreparedMultiPolygon(json.loads(boundaries)["coordinates"])
+            tiers = simplified.get(community_id, {})
+            tiers[FULL_RESOLUTION] = boundaries
+            entries.append((polygon.box, (Community(id=community_id, name=name), tiers, polygon)))
+
+        return BoundingBoxTree(entries)
+
+    @classmethod
+    def get_all_communities_payload(cls, tolerance=FULL_RESOLUTION):
+        """Return a Payload of the JSON list of all Communities with their id,
+        name and boundaries in GeoJSON format simplified to the given stored
+        tolerance, held in memory until the Community data changes.
+        """
+        return _all_communities_payloads[tolerance].get()
+
+    @classmethod
+    def _build_all_communities_payload(cls, tolerance):
+        """Serialize every Community, splicing in the GeoJSON produced by the
+        database without parsing it.
+        """
+        body = ",".join(
+            '{{"id": {}, "name": {}, "boundaries": {}}}'.format(json.dumps(community.id), json.dumps(community.name), boundaries)
+            for (community, boundaries) in cls.get_all_communities(tolerance))
+
+        return Payload(("[" + body + "]").encode("utf-8"))
 
     @classmethod
     def add_comunity(cls, community):
@@ -64,53 +130,57 @@ class Community(db.Model):
         else:
             existing_community = community
 
+        db.session.flush()
+        SimplifiedBoundaries.simplify_community(community.id)
+        invalidate(COMMUNITY_DATA_VERSION)
         db.session.commit()
         return community
 
     @staticmethod
-    def populate_db():
-        """Populate database with default community data."""
-        Community._parse_shapefile_and_populate_db("/db_info/communities/NEIGHBORHOODS_WGS84.shp")
-
-    @staticmethod
-    def _parse_shapefile_and_populate_db(file_path):
-        """Given a path to a shapefile containing Community information, 
-        parse the file and add each Community to the database.
+    def create_indexes():
+        """Create the spatial index used by boundary queries if it does not
+        already exist.
         """
-        if not os.path.exists(file_path):
-            print(file_path + " does not exist")
-        else:
-            sf = shapefile.Reader(file_path)
-
-            # Create a dict of {<field>: <index>}
-            field_dict = {}
-            for field in sf.fields:
-                field_dict[field[0]] = sf.fields.index(field) - 1
-
-            for shapeRecord in sf.shapeRecords():
-                Community.add_comunity(Community.from_dict({
-                    "id": shapeRecord.record[field_dict['AREA_S_CD']],
-                    "name": ' '.join(shapeRecord.record[field_dict['AREA_NAME']].split(' ')[:-1]),
-                    "boundaries": WKTElement(str(pygeoif.MultiPolygon(pygeoif.as_shape(Community._longlat_to_latlong(shapeRecord.shape.__geo_interface__)))), 4326)
-                    }))
-    
+        db.engine.execute(
+            "CREATE INDEX IF NOT EXISTS idx_community_boundaries "
+            "ON community USING GIST (boundaries);")
+        db.engine.execute("ANALYZE community;")
+
     @staticmethod
-    def _longlat_to_latlong(geojson):
-        """Given a GeoJSON in dict form, reverses the order of
-        the coordinates.
+    def populate_db(force=False):
+        """Populate database with default community data, in a single transaction.
+        Only the communities which changed since the last run are written.
         """
-        coordinates = geojson['coordinates']
-        new_coordinates = ()
+        result = ingest_dataset(
+            COMMUNITY_DATA_VERSION,
+            Community.__table__,
+            "id",
+            ["/db_info/communities/NEIGHBORHOODS_WGS84.shp"],
+            _parse_record,
+            force)
 
-        for polygon in coordinates:
-            new_polygon = (())
-            for point in polygon:
-                new_point = (point[1], point[0])
-                new_polygon += (new_point),
-            
-            new_coordinates += (new_polygon),
+        if result is not None and (result.upserted or result.deleted):
+            for community_id in result.upserted:
+                SimplifiedBoundaries.simplify_community(community_id)
+            invalidate(COMMUNITY_DATA_VERSION)
+        db.session.commit()
 
-        return {
-            'type': 'Polygon',
-            'coordinates': new_coordinates
-        }
+
+def _parse_record(record, shape):
+    """Given a shapefile record and polygon of a Community, return a dict of its
+    column values.
+    """
+    polygons = shapefile_polygons(coordinate_buffer(shape.points), shape.parts)
+    return {
+        "id": int(record['AREA_S_CD']),
+        "name": ' '.join(record['AREA_NAME'].split(' ')[:-1]),
+        # Shapefiles are in (longitude, latitude) order
+        "boundaries": multipolygon_ewkb([[swap_axes(ring) for ring in polygon] for polygon in polygons], 4326)
+    }
+
+
+_community_index = VersionedValue(COMMUNITY_DATA_VERSION, Community._build_community_index)
+_all_communities_payloads = {
+    tolerance: VersionedValue(COMMUNITY_DATA_VERSION, functools.partial(Community._build_all_communities_payload, tolerance))
+    for tolerance in [FULL_RESOLUTION] + [tier_tolerance for (_, tier_tolerance) in SIMPLIFICATION_TIERS]
+}
@@ -3,17 +3,35 @@ Community Resource
 ====================================
 The Community Resource module
 """
-import os
-import shapefile
-import pygeoif
+
+import json
+import functools
+
+from flask import current_app
 
 from .. import db
+from ..cache import SingleFlight, VersionedCache, invalidate
+from ..geometry import geography, METERS_PER_KM, coordinate_buffer, swap_axes, point_ewkb, grid_cell, cell_center, quantize_radius, search_shape
+from ..ingest import ingest_dataset
+from .resource_cluster import ResourceCluster
+from .geocode_cache import GeocodeCache
 from ..validators import is_valid_username, is_valid_email, is_valid_phone_number, is_valid_community_resource_name
-from geopy.geocoders import Nominatim
 from geopy.distance import vincenty
 from geoalchemy2 import WKTElement
 from geoalchemy2 import Geometry
-from sqlalchemy import Column, String, Integer, Boolean, Float, func, select
+from sqlalchemy import Column, String, Integer, Boolean, Float, Text, func, select, cast, literal_column
+from sqlalchemy.dialects.postgresql import JSON, aggregate_order_by
+from sqlalchemy.orm import deferred
+
+COMMUNITY_RESOURCE_DATA_VERSION = "community_resource"
+
+# Kilometers that radius searches are rounded up to when SEARCH_CELL_SIZE is set.
+SEARCH_RADIUS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50)
+SEARCH_CELL_CACHE_SIZE = 1024
+# Kilometers added to the cached search radius, covering the difference
+# between geopy's and PostGIS' ellipsoidal distances.
+SEARCH_MARGIN = 0.001
+
 
 class CommunityResource(db.Model):
     __tablename__ = "community_resources"
@@ -29,6 +47,10 @@ class CommunityResource(db.Model):
     website = Column(String(64), nullable=True)
     image_uri = Column(String(64), nullable=True)
     verified = Column(Boolean, default=False, nullable=False)
+    # The coordinates as a GeoJSON object, and the serialized detail document,
+    # kept up to date by refresh_documents whenever the row is written.
+    geojson = deferred(Column(JSON, nullable=True))
+    document = deferred(Column(Text, nullable=True))
 
     @property
     def location(self):
@@ -60,19 +82,76 @@ class CommunityResource(db.Model):
 
         return obj
 
+    def to_geo_json_dict(self, coordinates):
+        """Return a dictionary representation of this CommunityResource object
+        with the given GeoJSON string as its coordinates.
+        """
+        community_resource_geo_json = self.to_dict()
+        community_resource_geo_json['coordinates'] = [coordinates]
+
+        return community_resource_geo_json
+
     @classmethod
     def get_community_resource_by_id(cls, community_resource_id):
-        """Return a GeoJSON representation of the CommunityResource with the given id."""
-        community_resource = cls.query.filter_by(community_resource_id=community_resource_id).first()
+        """Return the serialized GeoJSON representation of the CommunityResource
+        with the given id.
+        """
+        result = db.session.query(CommunityResource.document).filter(
+                CommunityResource.community_resource_id == community_resource_id
+            ).first()
 
-        if community_resource is None:
+        if result is None:
             raise NoExistingCommunityResource("Community Resource does not exist.")
 
-        coordinate_json = db.session.query(func.ST_AsGeoJSON(CommunityResource.coordinates)).filter_by(community_resource_id=community_resource_id).first()
-        community_resource_geo_json = community_resource.to_dict()
-        community_resource_geo_json['coordinates'] = coordinate_json
+        return result[0]
 
-        return community_resource_geo_json
+    @classmethod
+    def get_community_resources_by_ids(cls, community_resource_ids):
+        """Return a JSON array of the GeoJSON representations of the
+        CommunityResources with the given ids, in the order given.  Ids without a
+        CommunityResource are skipped.
+        """
+        if not community_resource_ids:
+            return "[]"
+
+        documents = dict(db.session.query(
+                CommunityResource.community_resource_id, CommunityResource.document
+            ).filter(
+                CommunityResource.community_resource_id.in_(community_resource_ids)
+            ).all())
+
+        return "[" + ",".join(documents[community_resource_id] for community_resource_id in community_resource_ids if community_resource_id in documents) + "]"
+
+    @staticmethod
+    def refresh_documents(community_resource_ids=None):
+        """Recompute the stored GeoJSON and document of the CommunityResources
+        with the given ids, or of every CommunityResource if no ids are given.
+        The change is committed along with the caller's session.
+        """
+        table = CommunityResource.__table__
+        geojson = func.ST_AsGeoJSON(table.c.coordinates)
+        statement = table.update().values(
+            geojson=cast(geojson, JSON),
+            document=cast(func.json_build_object(
+                "id", table.c.community_resource_id,
+                "charity_number", table.c.charity_number,
+                "name", table.c.name,
+                "coordinates", func.json_build_array(geojson),
+                "contact_name", table.c.contact_name,
+                "email", table.c.email,
+                "phone_number", table.c.phone_number,
+                "address", table.c.address,
+                "website", table.c.website,
+                "image_uri", table.c.image_uri,
+                "verified", table.c.verified
+            ), Text))
+
+        if community_resource_ids is not None:
+            if not community_resource_ids:
+                return
+            statement = statement.where(table.c.community_resource_id.in_(community_resource_ids))
+
+        db.session.execute(statement)
 
     @classmethod
     def get_community_resource_by_charity_number(cls, charity_number):
@@ -88,48 +167,209 @@ class CommunityResource(db.Model):
 
         if existing_resource is None:
             db.session.add(resource)
+            db.session.flush()
+            ResourceCluster.add_resource(resource.community_resource_id)
+            CommunityResource.refresh_documents([resource.community_resource_id])
         else:
             existing_resource = resource
 
+        invalidate(COMMUNITY_RESOURCE_DATA_VERSION)
         db.session.commit()
         return resource
 
-    # Returns a list of resources within a given radius of latitude, longitude
     @classmethod
     def get_resources_by_radius(cls, longitude, latitude, radius):
-        """Given coordinates and a radius, return a list of CommunityResources within the
-        given radius around the given coordinates in GeoJSON format.
+        """Given coordinates and a radius in kilometers, return a JSON array of the
+        CommunityResources within the given radius around the given coordinates,
+        along with their distance in kilometers.  Results are sorted by distance,
+        closest first.
         """
-        return db.session.query(
-                CommunityResource, func.ST_AsGeoJSON(CommunityResource.coordinates)
+        point = geography(CommunityResource.long_lat_to_point(longitude, latitude))
+        location = geography(CommunityResource.coordinates)
+        distance = func.ST_Distance(location, point)
+
+        return CommunityResource._json_array(db.session.query(
+                *CommunityResource._summary_columns(),
+                (distance / METERS_PER_KM).label("distance")
             ).filter(
-                func.ST_DWITHIN(CommunityResource.coordinates, CommunityResource.long_lat_to_point(longitude, latitude), radius)
-            ).all()
-    
+                func.ST_DWithin(location, point, float(radius) * METERS_PER_KM)
+            ).order_by(
+                distance
+            ), "distance")
+
+    @classmethod
+    def get_resources_by_radius_quantized(cls, longitude, latitude, radius):
+        """Return the same JSON array as get_resources_by_radius, filtered in
+        memory from the cached CommunityResources near the SEARCH_CELL_SIZE grid
+        cell containing the given coordinates.  The radius is rounded up to one
+        of SEARCH_RADIUS_BUCKETS, so that nearby searches share the cached cell.
+
+        Falls back to get_resources_by_radius when SEARCH_CELL_SIZE is not set or
+        the radius is larger than every bucket.
+        """
+        x, y, radius = float(longitude), float(latitude), float(radius)
+        size = current_app.config["SEARCH_CELL_SIZE"]
+        bucket = quantize_radius(radius, SEARCH_RADIUS_BUCKETS)
+
+        if not size or bucket is None:
+            return cls.get_resources_by_radius(longitude, latitude, radius)
+
+        cell = grid_cell(x, y, size)
+        candidates = _search_cells.get((cell, bucket), functools.partial(cls._get_cell_candidates, cell, size, bucket))
+
+        # Coordinates are stored as (latitude, longitude)
+        results = []
+        for (summary, resource_x, resource_y) in candidates:
+            distance = vincenty((x, y), (resource_x, resource_y)).kilometers
+            if distance <= radius:
+                results.append((distance, summary))
+        results.sort(key=lambda result: result[0])
+
+        return json.dumps([dict(summary, distance=distance) for (distance, summary) in results])
+
+    @classmethod
+    def _get_cell_candidates(cls, cell, size, radius):
+        """Return a list of (summary dict, x, y) of every CommunityResource within
+        the given radius in kilometers of any point in the given grid cell.
+        """
+        center = cell_center(cell, size)
+        corners = [(center[0] + dx * size / 2, center[1] + dy * size / 2) for dx in (-1, 1) for dy in (-1, 1)]
+        margin = max(vincenty(center, corner).kilometers for corner in corners) + SEARCH_MARGIN
+
+        point = geography(CommunityResource.long_lat_to_point(*center))
+        location = geography(CommunityResource.coordinates)
+
+        return [({
+                "community_resource_id": community_resource_id,
+                "name": name,
+                "address": address,
+                "location": geojson
+            }, resource_x, resource_y) for (community_resource_id, name, address, geojson, resource_x, resource_y) in db.session.query(
+                CommunityResource.community_resource_id,
+                CommunityResource.name,
+                CommunityResource.address,
+                CommunityResource.geojson,
+                func.ST_X(CommunityResource.coordinates),
+                func.ST_Y(CommunityResource.coordinates)
+            ).filter(
+                func.ST_DWithin(location, point, (radius + margin) * METERS_PER_KM)
+            ).all()]
+
+    @classmethod
+    def get_nearest_resources(cls, longitude, latitude, limit):
+        """Given coordinates, return a JSON array of the given number of
+        CommunityResources closest to the coordinates, along with their distance
+        in kilometers.  Results are sorted by distance, closest first.
+        """
+        point = geography(CommunityResource.long_lat_to_point(longitude, latitude))
+        location = geography(CommunityResource.coordinates)
+
+        return CommunityResource._json_array(db.session.query(
+                *CommunityResource._summary_columns(),
+                (func.ST_Distance(location, point) / METERS_PER_KM).label("distance")
+            ).order_by(
+                location.op("<->")(point)
+            ).limit(
+                int(limit)
+            ), "distance")
+
     @classmethod
     def get_resources_in_shape(cls, polygon_string):
-        """Given a polygon, return a list of CommunityResources within the given polygon
-        in GeoJSON format.
+        """Given a polygon, return a JSON array of the CommunityResources within
+        the given polygon.  Concurrent searches for the same polygon share one
+        query.
+
+        Raises InvalidPolygon if the polygon is malformed or too costly to
+        search, see search_shape.
         """
-        polygon = WKTElement(polygon_string, 4326)
-        return db.session.query(
-                CommunityResource, func.ST_AsGeoJSON(CommunityResource.coordinates)
+        shape, box = search_shape(polygon_string)
+        return _shape_searches.do(
+            polygon_string,
+            functools.partial(cls._query_resources_in_shape, shape, box),
+            current_app.config["SINGLE_FLIGHT_TIMEOUT"])
+
+    @classmethod
+    def _query_resources_in_shape(cls, shape, box):
+        return CommunityResource._json_array(db.session.query(
+                *CommunityResource._summary_columns()
             ).filter(
-                func.ST_Contains(polygon, CommunityResource.coordinates)
-            ).all()
+                CommunityResource.coordinates.op("&&")(box),
+                func.ST_Contains(shape, CommunityResource.coordinates)
+            ))
+
+    @staticmethod
+    def _summary_columns():
+        """Return the columns listed for each CommunityResource in search results,
+        with the location as a GeoJSON object.
+        """
+        return [
+            CommunityResource.community_resource_id,
+            CommunityResource.name,
+            CommunityResource.address,
+            CommunityResource.geojson.label("location")
+        ]
+
+    @staticmethod
+    def _json_array(query, order_by=None):
+        """Return the rows of the given query as a JSON array of objects, built by
+        the database, ordered by the given column of the query.
+        """
+        rows = query.subquery("rows")
+        row = literal_column("rows")
+        if order_by is not None:
+            row = aggregate_order_by(row, rows.c[order_by])
+
+        return db.session.query(
+            cast(func.coalesce(func.json_agg(row), literal_column("'[]'::json")), Text)
+        ).scalar()
+
+    @staticmethod
+    def geocode_address(address):
+        """Return the given address' (longitude, latitude)."""
+        coordinates = GeocodeCache.geocode(address)
+
+        if coordinates is None:
+            raise InvalidCommunityResourceInfo("Address could not be geocoded.")
+
+        return coordinates
+
+    @classmethod
+    def geocode_resources(cls):
+        """Move every CommunityResource with an address to its geocoded location,
+        looking the addresses up together, see GeocodeCache.geocode_many.
+        Resources whose address cannot be geocoded are left where they are.  The
+        change is committed along with the caller's session.
+
+        :returns: The number of CommunityResources moved.
+        """
+        resources = cls.query.filter(cls.address != "").all()
+        locations = GeocodeCache.geocode_many([resource.address for resource in resources])
+
+        moved = []
+        for (resource, location) in zip(resources, locations):
+            if location is not None:
+                resource.coordinates = CommunityResource.location_to_point(*location)
+                moved.append(resource.community_resource_id)
+
+        if moved:
+            db.session.flush()
+            ResourceCluster.rebuild()
+            CommunityResource.refresh_documents(moved)
+            invalidate(COMMUNITY_RESOURCE_DATA_VERSION)
+
+        return len(moved)
 
     @staticmethod
     def coordinates_from_address(address):
         """Return the given address' coordinates."""
-        geolocator = Nominatim()
-        location = geolocator.geocode(address)
+        longitude, latitude = CommunityResource.geocode_address(address)
 
-        return CommunityResource.long_lat_to_point(location.longitude, location.latitude)
+        return CommunityResource.location_to_point(longitude, latitude)
 
     @classmethod
     def edit_community_resource(cls, community_resource_id, new_name, new_lat, new_long, new_contact_name, new_email, new_phone_number, new_address, new_website, new_image_uri):
         """Update and return the existing CommunityResource with the given id."""
-        resource = cls.get_resource_by_id(community_resource_id)
+        resource = cls.query.filter_by(community_resource_id=community_resource_id).first()
 
         if resource is None:
             raise NoExistingCommunityResource(
@@ -145,8 +385,10 @@ class CommunityResource(db.Model):
             raise InvalidCommunityResourceInfo(
                 "New resource center name cannot be empty")
 
+        ResourceCluster.add_resource(resource.community_resource_id, -1)
+
         resource.name = new_name
-        resource.coordinates = CommunityResource.long_lat_to_point(new_long, new_lat)
+        resource.coordinates = CommunityResource.location_to_point(new_long, new_lat)
         resource.contact_name = new_contact_name
         resource.email = new_email
         resource.phone_number = new_phone_number
@@ -154,6 +396,10 @@ class CommunityResource(db.Model):
         resource.website = new_website
         resource.image_uri = new_image_uri
 
+        db.session.flush()
+        ResourceCluster.add_resource(resource.community_resource_id)
+        CommunityResource.refresh_documents([resource.community_resource_id])
+        invalidate(COMMUNITY_RESOURCE_DATA_VERSION)
         db.session.commit()
 
         return resource
@@ -163,43 +409,72 @@ class CommunityResource(db.Model):
         """Return a WKTElement of the point with the given coordinates."""
         pointString = "POINT({} {})".format(longitude, latitude)
         return WKTElement(pointString, 4326)
+
+    @staticmethod
+    def location_to_point(longitude, latitude):
+        """Return a WKTElement of the point at the given geographic coordinates,
+        such as those returned by geocode_address, in the (latitude, longitude)
+        order coordinates are stored in.
+        """
+        return CommunityResource.long_lat_to_point(latitude, longitude)
     
     @staticmethod
-    def populate_db():
-        """Populate database with default data.
+    def create_indexes():
+        """Create the spatial indexes used by location queries if they do not
+        already exist.  The geography index backs the distance based queries,
+        and the geometry index backs the shape based queries.
         """
-        CommunityResource._parse_shapefile_and_populate_db("/db_info/shelters/shelters_wgs84.shp")
-        CommunityResource._parse_shapefile_and_populate_db("/db_info/dropins/TDIN_wgs84.shp")
+        db.engine.execute(
+            "CREATE INDEX IF NOT EXISTS idx_community_resources_coordinates "
+            "ON community_resources USING GIST (coordinates);")
+        db.engine.execute(
+            "CREATE INDEX IF NOT EXISTS idx_community_resources_geography "
+            "ON community_resources USING GIST (geography(ST_FlipCoordinates(coordinates)));")
+        db.engine.execute("ANALYZE community_resources;")
 
     @staticmethod
-    def _parse_shapefile_and_populate_db(file_path):
-        """Populate database with data from the shapefile with the given path."""
-        if not os.path.exists(file_path):
-            print(file_path + " does not exist")
-        else:
-            sf = shapefile.Reader(file_path)
-
-            # Create a dict of {<field>: <index>}
-            field_dict = {}
-            for field in sf.fields:
-                field_dict[field[0]] = sf.fields.index(field) - 1
-
-            for shapeRecord in sf.shapeRecords():
-                reversed = (shapeRecord.shape.__geo_interface__['coordinates'][1], shapeRecord.shape.__geo_interface__['coordinates'][0])
-                coordinates = pygeoif.Point(pygeoif.geometry.as_shape({'type':'Point', 'coordinates': reversed}))
-                CommunityResource.add_community_resource(CommunityResource.from_dict({
-                    "community_resource_id": shapeRecord.record[field_dict['OBJECTID']],
-                    "charity_number": shapeRecord.record[field_dict['OBJECTID']],
-                    "name": shapeRecord.record[field_dict['NAME']],
-                    "coordinates": WKTElement(str(pygeoif.Point(pygeoif.as_shape(coordinates))), 4326),
-                    "contact_name":"",
-                    "email":"",
-                    "phone_number":"",
-                    "address":"",
-                    "website":"",
-                    "image_uri":"",
-                    "verified": True
-                    }))
+    def populate_db(force=False):
+        """Populate database with default data, in a single transaction.  Only
+        the resources which changed since the last run are written.
+        """
+        result = ingest_dataset(
+            COMMUNITY_RESOURCE_DATA_VERSION,
+            CommunityResource.__table__,
+            "community_resource_id",
+            ["/db_info/shelters/shelters_wgs84.shp", "/db_info/dropins/TDIN_wgs84.shp"],
+            _parse_record,
+            force)
+
+        if result is not None and (result.upserted or result.deleted):
+            CommunityResource.refresh_documents(result.upserted)
+            ResourceCluster.rebuild()
+            invalidate(COMMUNITY_RESOURCE_DATA_VERSION)
+        db.session.commit()
+
+
+def _parse_record(record, shape):
+    """Given a shapefile record and point of a CommunityResource, return a dict
+    of its column values.
+    """
+    return {
+        "community_resource_id": record['OBJECTID'],
+        "charity_number": record['OBJECTID'],
+        "name": record['NAME'],
+        # Shapefiles are in (longitude, latitude) order
+        "coordinates": point_ewkb(swap_axes(coordinate_buffer(shape.points)), 4326),
+        "contact_name": "",
+        "email": "",
+        "phone_number": "",
+        "address": "",
+        "website": "",
+        "image_uri": "",
+        "verified": True
+    }
+
+
+# {<(grid cell, radius bucket)>: <list of (summary dict, x, y)>}
+_search_cells = VersionedCache([COMMUNITY_RESOURCE_DATA_VERSION], SEARCH_CELL_CACHE_SIZE)
+_shape_searches = SingleFlight()
 
 
 class NoExistingCommunityResource(Exception):
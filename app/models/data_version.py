@@ -0,0 +1,37 @@
+"""
+Data Version
+====================================
+The Data Version module
+"""
+from .. import db
+from sqlalchemy import Column, String, Integer
+
+
+class DataVersion(db.Model):
+    """A counter which is incremented whenever a named dataset is written, so
+    that caches held by any worker can detect that they are stale.
+    """
+    __tablename__ = "data_versions"
+
+    name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def get_version(cls, name):
+        """Return the current version of the dataset with the given name."""
+        version = db.session.query(cls.version).filter_by(name=name).scalar()
+
+        if version is None:
+            return 0
+
+        return version
+
+    @classmethod
+    def bump_version(cls, name):
+        """Increment the version of the dataset with the given name.  The change
+        is committed along with the caller's session.
+        """
+        db.session.execute(
+            "INSERT INTO data_versions (name, version) VALUES (:name, 1) "
+            "ON CONFLICT (name) DO UPDATE SET version = data_versions.version + 1",
+            {"name": name})
@@ -0,0 +1,129 @@
+"""
+Geocode Cache
+====================================
+The Geocode Cache module
+"""
+import datetime
+import collections
+
+from flask import current_app
+
+from .. import db
+from ..cache import LRUCache
+from ..geocoders import get_geocoder, normalize_address
+from sqlalchemy import Column, String, Float, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+GEOCODE_MEMORY_CACHE_SIZE = 1024
+
+# Number of geocode lookups answered by each tier, keyed by "memory",
+# "database" and "geocoder".
+geocode_stats = collections.Counter()
+
+# {<normalized address>: <(longitude, latitude) or None>}
+_memory_cache = LRUCache(GEOCODE_MEMORY_CACHE_SIZE)
+
+
+class GeocodeCache(db.Model):
+    """The coordinates of a normalized address, or None for both if the address
+    could not be geocoded, valid until expires_at.
+    """
+    __tablename__ = "geocode_cache"
+
+    address = Column(String(256), primary_key=True)
+    longitude = Column(Float, nullable=True)
+    latitude = Column(Float, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    @property
+    def coordinates(self):
+        """Return the cached (longitude, latitude), or None if the address could
+        not be geocoded.
+        """
+        if self.longitude is None or self.latitude is None:
+            return None
+        return (self.longitude, self.latitude)
+
+    @classmethod
+    def geocode(cls, address):
+        """Return the (longitude, latitude) of the given address, or None if it
+        could not be geocoded.
+
+        Results are cached in memory and in the database, keyed on the normalized
+        address, for GEOCODE_CACHE_TTL seconds.  Addresses which could not be
+        geocoded are cached for GEOCODE_NEGATIVE_CACHE_TTL seconds.
+        """
+        return cls.geocode_many([address])[0]
+
+    @classmethod
+    def geocode_many(cls, addresses):
+        """Return a list of the (longitude, latitude), or None, of each of the
+        given addresses, cached like geocode.  Addresses which are not cached are
+        looked up together with the geocoder's geocode_many.
+        """
+        now = datetime.datetime.utcnow()
+        keys = [normalize_address(address) for address in addresses]
+        # {<normalized address>: <coordinates or None>}
+        found = {}
+        # {<normalized address>: <address>} of the addresses to look up
+        lookups = collections.OrderedDict()
+
+        missing = object()
+        for (key, address) in zip(keys, addresses):
+            if key in found or key in lookups:
+                continue
+
+            coordinates = _memory_cache.get(key, missing)
+            if coordinates is not missing:
+                geocode_stats["memory"] += 1
+                found[key] = coordinates
+                continue
+
+            cached = cls.query.get(key)
+            if cached is not None and cached.expires_at > now:
+                geocode_stats["database"] += 1
+                _memory_cache.set(key, cached.coordinates, (cached.expires_at - now).total_seconds())
+                found[key] = cached.coordinates
+                continue
+
+            lookups[key] = address
+
+        if lookups:
+            geocode_stats["geocoder"] += len(lookups)
+            results = get_geocoder().geocode_many(list(lookups.values()))
+
+            for (key, coordinates) in zip(lookups, results):
+                if coordinates is None:
+                    ttl = current_app.config["GEOCODE_NEGATIVE_CACHE_TTL"]
+                else:
+                    ttl = current_app.config["GEOCODE_CACHE_TTL"]
+
+                cls._store(key, coordinates, now + datetime.timedelta(seconds=ttl))
+                _memory_cache.set(key, coordinates, ttl)
+                found[key] = coordinates
+
+        return [found[key] for key in keys]
+
+    @classmethod
+    def _store(cls, address, coordinates, expires_at):
+        """Store the coordinates of the given normalized address in a separate
+        transaction, so that the caller's pending changes are not committed
+        with it.  Concurrent lookups of the same address overwrite each other.
+        """
+        statement = insert(cls.__table__).values(
+            address=address,
+            longitude=coordinates[0] if coordinates else None,
+            latitude=coordinates[1] if coordinates else None,
+            expires_at=expires_at)
+        statement = statement.on_conflict_do_update(
+            index_elements=["address"],
+            set_={name: statement.excluded[name] for name in ("longitude", "latitude", "expires_at")})
+
+        with db.engine.begin() as connection:
+            connection.execute(statement)
+
+    @staticmethod
+    def clear_expired():
+        """Delete every expired entry from the database."""
+        GeocodeCache.query.filter(GeocodeCache.expires_at <= datetime.datetime.utcnow()).delete()
+        db.session.commit()
@@ -0,0 +1,80 @@
+"""
+Outbox Email
+====================================
+The Outbox Email module
+"""
+import datetime
+
+from .. import db
+from sqlalchemy import Column, Integer, String, Text, DateTime, func
+
+
+class OutboxEmail(db.Model):
+    """An email waiting to be sent by the mail worker.  Emails are written in
+    the same transaction as the change that caused them, so none are lost or
+    sent for changes which were rolled back.
+    """
+    __tablename__ = "outbox_emails"
+
+    id = Column(Integer, primary_key=True)
+    recipient = Column(String(256), nullable=False)
+    subject = Column(String(256), nullable=False)
+    body = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    attempts = Column(Integer, nullable=False, default=0)
+    # The earliest time of the next attempt, or None once sent or given up on.
+    next_attempt_at = Column(DateTime, nullable=True, index=True, default=datetime.datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+
+    @staticmethod
+    def enqueue(recipient, subject, body):
+        """Queue an email.  The email is committed along with the caller's
+        session.
+        """
+        email = OutboxEmail(recipient=recipient, subject=subject, body=body)
+        db.session.add(email)
+        return email
+
+    @classmethod
+    def claim_due(cls, limit):
+        """Return up to limit emails which are due to be sent, oldest first,
+        locking them until the caller's transaction ends.  Emails locked by
+        another worker are skipped.
+        """
+        return cls.query.filter(cls.next_attempt_at <= datetime.datetime.utcnow()) \
+            .order_by(cls.next_attempt_at, cls.id) \
+            .limit(limit) \
+            .with_for_update(skip_locked=True) \
+            .all()
+
+    def mark_sent(self):
+        """Record that this email was sent."""
+        self.attempts += 1
+        self.sent_at = datetime.datetime.utcnow()
+        self.next_attempt_at = None
+        self.last_error = None
+
+    def mark_failed(self, error, retry_after=None):
+        """Record a failed attempt to send this email, retrying it after
+        retry_after seconds, or never if retry_after is None.
+        """
+        self.attempts += 1
+        self.last_error = error
+        if retry_after is None:
+            self.next_attempt_at = None
+        else:
+            self.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=retry_after)
+
+    @classmethod
+    def queue_depth(cls):
+        """Return the number of emails waiting to be sent, and the age in seconds
+        of the oldest of them, or None if there are none.
+        """
+        count, oldest = db.session.query(func.count(cls.id), func.min(cls.created_at)) \
+            .filter(cls.next_attempt_at.isnot(None)) \
+            .one()
+
+        if oldest is None:
+            return count, None
+        return count, (datetime.datetime.utcnow() - oldest).total_seconds()
@@ -0,0 +1,139 @@
+"""
+Resource Cluster
+====================================
+The Resource Cluster module
+"""
+from .. import db
+from ..geometry import geography, search_shape, METERS_PER_KM
+from geoalchemy2 import Geometry, WKTElement
+from sqlalchemy import Column, Integer, Float, func
+
+CLUSTER_MAX_ZOOM = 18
+# Grid cells per map tile width, so clusters are about 64 pixels apart.
+CLUSTER_CELLS_PER_TILE = 4
+
+# The grid cell of every community resource at every zoom level.
+RESOURCE_CELLS = """
+SELECT zoom,
+       floor(ST_X(coordinates) / (360.0 / (:cells_per_tile * 2 ^ zoom)))::integer AS cell_x,
+       floor(ST_Y(coordinates) / (360.0 / (:cells_per_tile * 2 ^ zoom)))::integer AS cell_y,
+       ST_X(coordinates) AS x,
+       ST_Y(coordinates) AS y
+FROM community_resources, generate_series(0, :max_zoom) AS zoom
+"""
+
+# The centroid of a cell's resources from its sums, or NULL once it is empty.
+CENTROID = "ST_SetSRID(ST_MakePoint({sum_x} / NULLIF({count}, 0), {sum_y} / NULLIF({count}, 0)), 4326)"
+
+
+class ResourceCluster(db.Model):
+    """The number of CommunityResources in one grid cell at one map zoom level,
+    and the sum of their coordinates so that their centroid can be found.
+    """
+    __tablename__ = "resource_clusters"
+
+    zoom = Column(Integer, primary_key=True)
+    cell_x = Column(Integer, primary_key=True)
+    cell_y = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+    sum_x = Column(Float, nullable=False)
+    sum_y = Column(Float, nullable=False)
+    # Stored so that searches can use a spatial index.
+    centroid_point = Column(Geometry('POINT', srid=4326), nullable=True)
+
+    @property
+    def centroid(self):
+        """Return the centroid of the CommunityResources in this cell as a GeoJSON dict."""
+        return {"type": "Point", "coordinates": [self.sum_x / self.count, self.sum_y / self.count]}
+
+    def to_dict(self):
+        """Return a dictionary representation of this ResourceCluster object."""
+        return {
+            "count": self.count,
+            "location": self.centroid
+        }
+
+    @staticmethod
+    def add_resource(community_resource_id, count=1):
+        """Add the CommunityResource with the given id to its cell at every zoom
+        level, or remove it when count is -1.  The change is committed along with
+        the caller's session.
+        """
+        params = {
+            "community_resource_id": community_resource_id,
+            "count": count,
+            "cells_per_tile": CLUSTER_CELLS_PER_TILE,
+            "max_zoom": CLUSTER_MAX_ZOOM
+        }
+        cells = "(" + RESOURCE_CELLS + " WHERE community_resource_id = :community_resource_id) AS cells"
+
+        db.session.execute(
+            "INSERT INTO resource_clusters (zoom, cell_x, cell_y, count, sum_x, sum_y, centroid_point) "
+            "SELECT zoom, cell_x, cell_y, :count, :count * x, :count * y, " + CENTROID.format(sum_x="x", sum_y="y", count="1") + " "
+            "FROM " + cells + " "
+            "ON CONFLICT (zoom, cell_x, cell_y) DO UPDATE SET "
+            "count = resource_clusters.count + EXCLUDED.count, "
+            "sum_x = resource_clusters.sum_x + EXCLUDED.sum_x, "
+            "sum_y = resource_clusters.sum_y + EXCLUDED.sum_y, "
+            "centroid_point = " + CENTROID.format(
+                sum_x="(resource_clusters.sum_x + EXCLUDED.sum_x)",
+                sum_y="(resource_clusters.sum_y + EXCLUDED.sum_y)",
+                count="(resource_clusters.count + EXCLUDED.count)"),
+            params)
+
+        if count < 0:
+            # Only the cells of this resource can have been emptied
+            db.session.execute(
+                "DELETE FROM resource_clusters "
+                "WHERE count <= 0 AND (zoom, cell_x, cell_y) IN (SELECT zoom, cell_x, cell_y FROM " + cells + ")",
+                params)
+
+    @staticmethod
+    def rebuild():
+        """Recompute every cell from the CommunityResources table.  The change is
+        committed along with the caller's session.
+        """
+        db.session.execute("DELETE FROM resource_clusters")
+        db.session.execute(
+            "INSERT INTO resource_clusters (zoom, cell_x, cell_y, count, sum_x, sum_y, centroid_point) "
+            "SELECT zoom, cell_x, cell_y, count(*), sum(x), sum(y), " + CENTROID.format(sum_x="sum(x)", sum_y="sum(y)", count="count(*)") + " "
+            "FROM (" + RESOURCE_CELLS + ") AS cells "
+            "GROUP BY zoom, cell_x, cell_y",
+            {"cells_per_tile": CLUSTER_CELLS_PER_TILE, "max_zoom": CLUSTER_MAX_ZOOM})
+
+    @classmethod
+    def get_clusters_by_radius(cls, zoom, longitude, latitude, radius):
+        """Return the ResourceClusters at the given zoom level whose centroids are
+        within the given radius in kilometers of the given coordinates.
+        """
+        point = geography(WKTElement("POINT({} {})".format(longitude, latitude), 4326))
+        return cls.query.filter(
+                cls.zoom == min(int(zoom), CLUSTER_MAX_ZOOM),
+                func.ST_DWithin(geography(cls.centroid_point), point, float(radius) * METERS_PER_KM)
+            ).all()
+
+    @classmethod
+    def get_clusters_in_shape(cls, zoom, polygon_string):
+        """Return the ResourceClusters at the given zoom level whose centroids are
+        within the given polygon.
+
+        Raises InvalidPolygon if the polygon is malformed or has too many
+        vertices, see search_shape.  Its area is not limited, since there are
+        few cells per zoom level and low zoom levels cover large areas.
+        """
+        shape, box = search_shape(polygon_string, limit_area=False)
+        return cls.query.filter(
+                cls.zoom == min(int(zoom), CLUSTER_MAX_ZOOM),
+                cls.centroid_point.op("&&")(box),
+                func.ST_Contains(shape, cls.centroid_point)
+            ).all()
+
+    @staticmethod
+    def create_indexes():
+        """Create the geography index backing radius searches if it does not
+        already exist.  The geometry index on centroid_point, which backs shape
+        searches, is created along with the table.
+        """
+        db.engine.execute(
+            "CREATE INDEX IF NOT EXISTS idx_resource_clusters_geography "
+            "ON resource_clusters USING GIST (geography(ST_FlipCoordinates(centroid_point)));")
@@ -0,0 +1,67 @@
+"""
+Simplified Boundaries
+====================================
+The Simplified Boundaries module
+"""
+from .. import db
+from geoalchemy2 import Geometry
+from sqlalchemy import Column, Integer, Float, ForeignKey
+
+FULL_RESOLUTION = 0.0
+
+# (minimum map zoom level, simplification tolerance in degrees), coarsest first.
+# Zoom levels past the last tier are served at full resolution.
+SIMPLIFICATION_TIERS = (
+    (0, 0.001),
+    (12, 0.0003),
+    (14, 0.0001)
+)
+FULL_RESOLUTION_ZOOM = 16
+
+
+def select_tolerance(zoom=None, tolerance=None):
+    """Return the stored simplification tolerance to serve for a map zoom level
+    or a maximum tolerance in degrees.  Returns FULL_RESOLUTION when neither is
+    given, or when no stored tier is precise enough.
+    """
+    if zoom is not None:
+        if zoom >= FULL_RESOLUTION_ZOOM:
+            return FULL_RESOLUTION
+        return [tier_tolerance for (min_zoom, tier_tolerance) in SIMPLIFICATION_TIERS if min_zoom <= zoom][-1]
+
+    if tolerance is not None:
+        for (_, tier_tolerance) in SIMPLIFICATION_TIERS:
+            if tier_tolerance <= tolerance:
+                return tier_tolerance
+
+    return FULL_RESOLUTION
+
+
+class SimplifiedBoundaries(db.Model):
+    """A Community's boundaries simplified to one of the SIMPLIFICATION_TIERS."""
+    __tablename__ = "simplified_boundaries"
+
+    community_id = Column(Integer, ForeignKey("community.id", ondelete="CASCADE"), primary_key=True)
+    tolerance = Column(Float, primary_key=True)
+    boundaries = Column(Geometry('MULTIPOLYGON', srid=4326), nullable=False)
+
+    @staticmethod
+    def simplify_community(community_id=None):
+        """Store every simplification tier of the Community with the given id, or
+        of every Community if no id is given, replacing any existing tiers.  The
+        change is committed along with the caller's session.
+        """
+        params = {}
+        where = ""
+        if community_id is not None:
+            where = "WHERE id = :community_id "
+            params["community_id"] = community_id
+
+        for (_, tolerance) in SIMPLIFICATION_TIERS:
+            params["tolerance"] = tolerance
+            db.session.execute(
+                "INSERT INTO simplified_boundaries (community_id, tolerance, boundaries) "
+                "SELECT id, :tolerance, ST_Multi(ST_SimplifyPreserveTopology(boundaries, :tolerance)) "
+                "FROM community " + where +
+                "ON CONFLICT (community_id, tolerance) DO UPDATE SET boundaries = EXCLUDED.boundaries",
+                params)
@@ -0,0 +1,30 @@
+"""
+Source File
+====================================
+The Source File module
+"""
+from .. import db
+from sqlalchemy import Column, String
+
+
+class SourceFile(db.Model):
+    """The content hash of a dataset file as of its last ingest."""
+    __tablename__ = "source_files"
+
+    path = Column(String(256), primary_key=True)
+    checksum = Column(String(64), nullable=False)
+
+    @classmethod
+    def get_checksums(cls, paths):
+        """Return a dict of {<path>: <checksum>} of the given files as of their
+        last ingest.  Files which were never ingested are left out.
+        """
+        return dict(db.session.query(cls.path, cls.checksum).filter(cls.path.in_(paths)).all())
+
+    @classmethod
+    def set_checksums(cls, checksums):
+        """Store the given dict of {<path>: <checksum>}.  The change is committed
+        along with the caller's session.
+        """
+        for (path, checksum) in checksums.items():
+            db.session.merge(cls(path=path, checksum=checksum))
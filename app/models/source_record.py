@@ -0,0 +1,44 @@
+"""
+Source Record
+====================================
+The Source Record module
+"""
+from .. import db
+from sqlalchemy import Column, String
+
+
+class SourceRecord(db.Model):
+    """The content hash of one record of a dataset as of its last ingest, keyed
+    on the primary key of the row it was written to.
+    """
+    __tablename__ = "source_records"
+
+    dataset = Column(String(64), primary_key=True)
+    key = Column(String(64), primary_key=True)
+    checksum = Column(String(64), nullable=False)
+
+    @classmethod
+    def get_checksums(cls, dataset):
+        """Return a dict of {<key>: <checksum>} of every record of the given
+        dataset as of its last ingest.
+        """
+        return dict(db.session.query(cls.key, cls.checksum).filter_by(dataset=dataset).all())
+
+    @classmethod
+    def set_checksums(cls, dataset, checksums):
+        """Store the given dict of {<key>: <checksum>} for the given dataset.  The
+        change is committed along with the caller's session.
+        """
+        if checksums:
+            db.session.execute(
+                "INSERT INTO source_records (dataset, key, checksum) VALUES (:dataset, :key, :checksum) "
+                "ON CONFLICT (dataset, key) DO UPDATE SET checksum = EXCLUDED.checksum",
+                [{"dataset": dataset, "key": key, "checksum": checksum} for (key, checksum) in checksums.items()])
+
+    @classmethod
+    def delete_keys(cls, dataset, keys):
+        """Forget the records of the given dataset with the given keys.  The
+        change is committed along with the caller's session.
+        """
+        if keys:
+            cls.query.filter(cls.dataset == dataset, cls.key.in_(keys)).delete(synchronize_session=False)
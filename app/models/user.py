@@ -4,20 +4,87 @@ User
 The User module
 """
 
-from flask import current_app
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, has_app_context
 from werkzeug.security import check_password_hash, generate_password_hash
-from ..validators import is_valid_username
+from ..validators import is_valid_username, is_valid_email
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import make_transient_to_detached
 from jwt import InvalidTokenError, ExpiredSignatureError
-from email.message import EmailMessage
 
 from .. import db
+from ..cache import VersionedValue, invalidate
+from .outbox_email import OutboxEmail
 
 import jwt
 import datetime
+import threading
 
 USER_ROLE_USER = "user"
 USER_ROLE_ADMIN = "admin"
 
+USER_DATA_VERSION = "user"
+
+# Used outside of an application context.
+DEFAULT_PASSWORD_HASH_METHOD = "pbkdf2:sha256"
+DEFAULT_PASSWORD_HASH_ITERATIONS = 50000
+
+USER_IMPORT_BATCH_SIZE = 500
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+def password_hash_method():
+    """Returns the Werkzeug password hash method configured by
+    PASSWORD_HASH_METHOD and PASSWORD_HASH_ITERATIONS.
+
+    :returns: A method string such as "pbkdf2:sha256:50000"
+    """
+    if has_app_context():
+        method = current_app.config["PASSWORD_HASH_METHOD"]
+        iterations = current_app.config["PASSWORD_HASH_ITERATIONS"]
+    else:
+        method = DEFAULT_PASSWORD_HASH_METHOD
+        iterations = DEFAULT_PASSWORD_HASH_ITERATIONS
+
+    if method.startswith("pbkdf2:"):
+        return "{}:{}".format(method, iterations)
+    return method
+
+
+def hash_password(password):
+    """Hashes a password with the configured method.  When PASSWORD_HASH_WORKERS
+    is set, the hash is computed on a pool of that many threads, so that no
+    more than that many hashes are computed at once.
+
+    :param password: plaintext password
+    :returns: The salted password hash
+    """
+    return hash_passwords([password])[0]
+
+
+def hash_passwords(passwords):
+    """Hashes a list of passwords with the configured method, concurrently when
+    PASSWORD_HASH_WORKERS is set.
+
+    :param passwords: A list of plaintext passwords
+    :returns: A list of the salted password hashes, in the same order
+    """
+    method = password_hash_method()
+    workers = current_app.config["PASSWORD_HASH_WORKERS"] if has_app_context() else 0
+
+    if not workers:
+        return [generate_password_hash(password, method) for password in passwords]
+
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers=workers)
+
+    return list(_hash_pool.map(lambda password: generate_password_hash(password, method), passwords))
+
 
 class User(db.Model):
     """The User Class"""
@@ -25,10 +92,13 @@ class User(db.Model):
     __tablename__ = "users"
 
     user_id = db.Column(db.Integer, primary_key=True, index=True)
-    email = db.Column(db.String(256), unique=True, nullable=False, index=True)
+    # Unique regardless of case, see uq_users_email_lower
+    email = db.Column(db.String(256), nullable=False)
     role = db.Column(db.String(64), default=USER_ROLE_USER, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
     active = db.Column(db.Boolean, default=False, nullable=False)
+    # Incremented to revoke every token issued to this user.
+    token_version = db.Column(db.Integer, default=0, nullable=False)
 
     @property
     def password(self):
@@ -36,15 +106,31 @@ class User(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def verify_password(self, password):
-        """Checks hashed user password against plaintext password
+        """Checks hashed user password against plaintext password, rehashing the
+        password if its hash was made with outdated parameters.
 
         :param password: plaintext password
         :returns: True if password hashes match, false otherwise
         """
-        return check_password_hash(self.password_hash, password)
+        if not check_password_hash(self.password_hash, password):
+            return False
+
+        if self.password_needs_rehash():
+            self.password = password
+            db.session.commit()
+
+        return True
+
+    def password_needs_rehash(self):
+        """Checks if the password hash was made with other than the configured
+        method or iterations.
+
+        :returns: True if the password should be rehashed
+        """
+        return self.password_hash.split("$", 1)[0] != password_hash_method()
 
     def generate_auth_token(self, expiration=600):
         """Generates a JSON Web Token which can be used to authenticate user requests.
@@ -55,6 +141,7 @@ class User(db.Model):
         token = {
             'user_id': self.user_id,
             'role': self.role,
+            'ver': self.token_version or 0,
             'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=expiration)
         }
 
@@ -78,7 +165,7 @@ class User(db.Model):
         :param email: An email used by a user
         :returns: The user object 
         """
-        return cls.query.filter_by(email=email.lower()).first()
+        return cls.query.filter(func.lower(cls.email) == email.lower()).first()
 
     @classmethod
     def get_user_by_token(cls, token):
@@ -98,28 +185,148 @@ class User(db.Model):
         except:
             return None
 
+    @classmethod
+    def get_claims_by_token(cls, token):
+        """Gets the verified claims of a token without loading the user.  Tokens
+        issued before the user's tokens were last revoked are rejected.
+
+        :param cls: This User object
+        :param token: A hash string used to identify a user
+        :returns: A dict with the user_id and role of the user, or None
+        """
+        try:
+            data = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=['HS256'])
+        except InvalidTokenError:
+            return None    # invalid or expired token
+
+        if data.get('user_id') is None or data.get('role') is None:
+            return None    # signed, but not an auth token, e.g. an activation hash
+
+        if data.get('ver', 0) < cls.get_token_version(data['user_id']):
+            return None    # revoked token
+
+        return data
+
+    @staticmethod
+    def get_token_version(user_id):
+        """Gets the current token version of a user without loading the user.
+
+        :param user_id: The id of the user
+        :returns: The version tokens must carry to be valid
+        """
+        return _token_versions.get().get(user_id, 0)
+
+    def revoke_tokens(self):
+        """Revoke every token issued to this user so far, along with any cached
+        credentials.  The change is committed along with the caller's session.
+
+        :param self: This user object
+        """
+        self.token_version = (self.token_version or 0) + 1
+        invalidate(USER_DATA_VERSION)
+
+    @staticmethod
+    def _build_token_versions():
+        """Return a dict of {<user_id>: <token_version>} of every user whose
+        tokens have been revoked.
+        """
+        return dict(db.session.query(User.user_id, User.token_version).filter(User.token_version > 0).all())
+
     @classmethod
     def add_user(cls, user):
         """Adds a user to the db.
         
         :param cls: This User object 
         :param user: A user object
-        :returns: The user object and a hashed email 
+        :returns: The user object and a hashed email, or None if the email is taken
         """
-        if cls.get_user_by_email(user.email.lower()) is not None:
+        user.email = user.email.lower()
+        user.role = user.role or USER_ROLE_USER
+        user.active = bool(user.active)
+        user.token_version = 0
+
+        user_ids = cls._insert_users([user])
+        if not user_ids:
+            db.session.rollback()
             return None
 
-        db.session.add(user)
-        db.session.commit()
-
-        # TODO: Figure out sending the email
         email_hash = jwt.encode(
-            {'email' : user.email.lower()},
+            {'email' : user.email},
             current_app.config['SECRET_KEY'],
             algorithm='HS256').decode('utf-8')
 
+        # Sent by the mail worker, so signup never waits on the mail server.
+        OutboxEmail.enqueue(
+            user.email,
+            "Activate your Dana account",
+            "Follow this link to activate your account:\n\n" + current_app.config["ACTIVATION_URL"].format(email_hash=email_hash))
+        db.session.commit()
+
+        # The row is already written, so attach the user without inserting it.
+        user.user_id = user_ids[0]
+        make_transient_to_detached(user)
+        db.session.add(user)
+
         return user, email_hash
 
+    @classmethod
+    def import_users(cls, rows, batch_size=USER_IMPORT_BATCH_SIZE):
+        """Adds users in bulk, skipping already registered emails and rows with
+        an invalid email, an empty password or an unknown role.
+
+        :param cls: This User object
+        :param rows: A list of dicts with an email, a password and optionally a role
+        :param batch_size: The number of users written per INSERT statement
+        :returns: The number of users added
+        """
+        rows = [row for row in rows if cls._is_valid_import_row(row)]
+        count = 0
+
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            password_hashes = hash_passwords([row["password"] for row in batch])
+
+            count += len(cls._insert_users([cls(
+                email=row["email"].strip().lower(),
+                role=row.get("role") or USER_ROLE_USER,
+                password_hash=password_hash,
+                active=False,
+                token_version=0) for (row, password_hash) in zip(batch, password_hashes)]))
+            db.session.commit()
+
+        return count
+
+    @staticmethod
+    def _is_valid_import_row(row):
+        """Checks that a row given to import_users can be added as a user.
+
+        :param row: A dict with an email, a password and optionally a role
+        :returns: True if the row is valid
+        """
+        return (is_valid_email((row.get("email") or "").strip())
+                and bool(row.get("password"))
+                and (row.get("role") or USER_ROLE_USER) in (USER_ROLE_ADMIN, USER_ROLE_USER))
+
+    @classmethod
+    def _insert_users(cls, users):
+        """Inserts users whose emails are not yet registered, in one statement.
+
+        :param cls: This User object
+        :param users: A list of unsaved user objects
+        :returns: A list of the ids of the users which were inserted
+        """
+        table = cls.__table__
+        statement = insert(table).values([{
+                "email": user.email,
+                "role": user.role,
+                "password_hash": user.password_hash,
+                "active": user.active,
+                "token_version": user.token_version
+            } for user in users])
+        statement = statement.on_conflict_do_nothing(index_elements=[func.lower(table.c.email)])
+
+        return [row[0] for row in db.session.execute(statement.returning(table.c.user_id))]
+
     def edit_user(self, username):
         """Change the username of a given user object.
         
@@ -157,6 +364,18 @@ class User(db.Model):
         :param password: the updated password
         """
         self.password = password
+        self.revoke_tokens()
+
+        db.session.commit()
+
+    def change_role(self, role):
+        """Update users role, revoking the tokens which carry the old one
+
+        :param self: This user object
+        :param role: the new role
+        """
+        self.role = role
+        self.revoke_tokens()
 
         db.session.commit()
 
@@ -188,6 +407,11 @@ class User(db.Model):
         return cls(**data)
 
 
+db.Index("uq_users_email_lower", func.lower(User.email), unique=True)
+
+_token_versions = VersionedValue(USER_DATA_VERSION, User._build_token_versions)
+
+
 class InvalidUserInfo(Exception):
     def __init__(self, message):
         Exception.__init__(self, message)
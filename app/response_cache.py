@@ -0,0 +1,200 @@
+"""
+Response Cache
+====================================
+A read-through cache of the responses of public GET endpoints, held in this
+process and optionally in a cache shared by every process.  Responses are
+discarded when a dataset they are built from is written, see cache.invalidate.
+"""
+import functools
+import json
+import threading
+
+import connexion
+
+from flask import current_app
+
+from .cache import LRUCache, VersionedCache, Payload
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+RESPONSE_CACHE_SIZE = 1024
+LOCAL_SHARED_CACHE_SIZE = 4096
+
+# {<operation name>: <ResponseCache>}
+response_caches = {}
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+class LocalSharedCache():
+    """An in-process stand-in for a shared cache, for tests and single process
+    deployments.
+    """
+
+    def __init__(self):
+        self._cache = LRUCache(LOCAL_SHARED_CACHE_SIZE)
+
+    def get(self, key):
+        """Return the bytes held for the given key, or None."""
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        """Hold the given bytes for the given key for ttl seconds."""
+        self._cache.set(key, value, ttl)
+
+
+class RedisSharedCache():
+    """A cache shared by every process, held in Redis."""
+
+    def __init__(self, url):
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        """Return the bytes held for the given key, or None."""
+        return self.redis.get(key)
+
+    def set(self, key, value, ttl):
+        """Hold the given bytes for the given key for ttl seconds."""
+        self.redis.setex(key, ttl, value)
+
+
+def get_shared_cache():
+    """Return the shared cache selected by the RESPONSE_CACHE_SHARED
+    configuration, or None if there is none.
+    """
+    url = current_app.config["RESPONSE_CACHE_SHARED"]
+    if not url:
+        return None
+
+    with _shared_caches_lock:
+        if url not in _shared_caches:
+            if url == "local":
+                _shared_caches[url] = LocalSharedCache()
+            elif redis is not None:
+                _shared_caches[url] = RedisSharedCache(url)
+            else:
+                raise ValueError("The redis package is required for RESPONSE_CACHE_SHARED=" + url)
+
+        return _shared_caches[url]
+
+
+class ResponseCache():
+    """The cached responses of one operation, built from the given datasets."""
+
+    def __init__(self, name, dataset_names, maxsize=RESPONSE_CACHE_SIZE):
+        """
+        :param name: The operation's name, which prefixes its shared cache keys.
+        :param dataset_names: The DataVersion names of the datasets the
+            responses are built from.
+        """
+        self.name = name
+        self.local = VersionedCache(dataset_names, maxsize)
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def get(self, key, build):
+        """Return the Payload for the given key, calling build to get the
+        response body if no tier holds it.  Bodies of None are not cached.
+        """
+        return self.local.get(key, functools.partial(self._get_shared, key, build))
+
+    def _get_shared(self, key, build):
+        shared = get_shared_cache()
+        if shared is None:
+            body = build()
+            return None if body is None else Payload(body)
+
+        # The key includes the dataset versions, so writes make entries stale
+        # in every process at once.
+        shared_key = "{}:{}:{}".format(self.name, ".".join(str(version) for version in self.local.versions), key)
+        body = shared.get(shared_key)
+        if body is not None:
+            self.shared_hits += 1
+            return Payload(body)
+
+        self.shared_misses += 1
+        body = build()
+        if body is None:
+            return None
+
+        shared.set(shared_key, body, current_app.config["RESPONSE_CACHE_TTL"])
+        return Payload(body)
+
+    def stats(self):
+        """Return a dict of this cache's size, hit and miss counts, and the
+        number of requests which waited for an identical request's response,
+        see SingleFlight.
+        """
+        return {
+            "size": len(self.local),
+            "hits": self.local.hits,
+            "misses": self.local.misses,
+            "coalesced": self.local.flights.coalesced,
+            "timeouts": self.local.flights.timeouts,
+            "shared_hits": self.shared_hits,
+            "shared_misses": self.shared_misses
+        }
+
+
+def request_key(kwargs):
+    """Return a key for the current request's query and path parameters, which
+    is the same regardless of their order.
+    """
+    parameters = sorted(connexion.request.args.items(multi=True))
+    parameters += sorted((name, str(value)) for (name, value) in kwargs.items())
+    return json.dumps(parameters)
+
+
+def _response_body(result):
+    """Return the body of a successful handler result as bytes, or None if the
+    result should not be cached.
+    """
+    if isinstance(result, tuple):
+        result, status = result[0], result[1]
+        if status != 200:
+            return None
+
+    if isinstance(result, current_app.response_class):
+        if result.status_code != 200:
+            return None
+        return result.get_data()
+
+    if result is None or result is connexion.NoContent:
+        return None
+
+    return json.dumps(result).encode("utf-8")
+
+
+def cached_response(*dataset_names):
+    """Decorate a public GET handler to cache its successful JSON responses per
+    set of request parameters, until one of the named datasets is written.
+    """
+    def decorator(handler):
+        cache = response_caches[handler.__name__] = ResponseCache(handler.__name__, dataset_names)
+
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            if not current_app.config["RESPONSE_CACHE"]:
+                return handler(*args, **kwargs)
+
+            result = []
+
+            def build():
+                result.append(handler(*args, **kwargs))
+                return _response_body(result[0])
+
+            payload = cache.get(request_key(kwargs), build)
+            if payload is None:
+                # A concurrent identical request's response was not cacheable
+                if not result:
+                    return handler(*args, **kwargs)
+                return result[0]
+            return payload.make_response(connexion.request)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,98 @@
+"""
+Tiles
+====================================
+Mapbox Vector Tiles of Community Resources and Communities.
+"""
+import math
+
+from . import db
+from .cache import Payload, VersionedCache
+from .models.community import COMMUNITY_DATA_VERSION
+from .models.community_resource import COMMUNITY_RESOURCE_DATA_VERSION
+from .models.simplified_boundaries import select_tolerance, FULL_RESOLUTION
+
+MVT_MIMETYPE = "application/vnd.mapbox-vector-tile"
+MAX_ZOOM = 22
+TILE_CACHE_SIZE = 1024
+
+# Half the width of the web mercator (EPSG:3857) world, in meters.
+WEB_MERCATOR_EXTENT = 20037508.342789244
+
+# Coordinates are stored as (latitude, longitude), by both populate_db and
+# CommunityResource.location_to_point, so the tile envelope is flipped into
+# that order for the index lookups and the stored geometries are flipped back
+# before they are projected.
+TILE_QUERY = """
+WITH bounds AS (
+    SELECT ST_MakeEnvelope(:min_x, :min_y, :max_x, :max_y, 3857) AS tile,
+           ST_FlipCoordinates(ST_Transform(ST_MakeEnvelope(:min_x, :min_y, :max_x, :max_y, 3857), 4326)) AS stored
+), resources AS (
+    SELECT community_resource_id AS id, name,
+           ST_AsMVTGeom(ST_Transform(ST_FlipCoordinates(coordinates), 3857), bounds.tile) AS geom
+    FROM community_resources, bounds
+    WHERE coordinates && bounds.stored
+), communities AS (
+    SELECT id, name,
+           ST_AsMVTGeom(ST_Transform(ST_FlipCoordinates(boundaries), 3857), bounds.tile) AS geom
+    FROM ({communities}) AS community, bounds
+    WHERE boundaries && bounds.stored
+)
+SELECT COALESCE((SELECT ST_AsMVT(resources, 'community_resources') FROM resources WHERE geom IS NOT NULL), ''::bytea)
+    || COALESCE((SELECT ST_AsMVT(communities, 'communities') FROM communities WHERE geom IS NOT NULL), ''::bytea)
+"""
+
+FULL_RESOLUTION_COMMUNITIES = "SELECT id, name, boundaries FROM community"
+SIMPLIFIED_COMMUNITIES = (
+    "SELECT community.id, community.name, simplified_boundaries.boundaries "
+    "FROM community JOIN simplified_boundaries ON simplified_boundaries.community_id = community.id "
+    "WHERE simplified_boundaries.tolerance = :tolerance")
+
+_tiles = VersionedCache([COMMUNITY_DATA_VERSION, COMMUNITY_RESOURCE_DATA_VERSION], maxsize=TILE_CACHE_SIZE)
+
+
+def is_valid_tile(z, x, y):
+    """Return True if the given tile coordinates exist."""
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z, x, y):
+    """Return the (min_x, min_y, max_x, max_y) web mercator bounds of the given tile."""
+    size = 2 * WEB_MERCATOR_EXTENT / 2 ** z
+
+    return (-WEB_MERCATOR_EXTENT + x * size,
+            WEB_MERCATOR_EXTENT - (y + 1) * size,
+            -WEB_MERCATOR_EXTENT + (x + 1) * size,
+            WEB_MERCATOR_EXTENT - y * size)
+
+
+def tile_containing(z, longitude, latitude):
+    """Return the (x, y) of the tile at zoom level z containing the given point."""
+    scale = 2 ** z
+    x = int((longitude + 180) / 360 * scale)
+    y = int((1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * scale)
+    return (min(max(x, 0), scale - 1), min(max(y, 0), scale - 1))
+
+
+def get_tile(z, x, y):
+    """Return a Payload of the vector tile with the given coordinates, with a
+    community_resources layer of points and a communities layer of polygons.
+    Tiles are held in memory until either dataset changes.
+    """
+    return _tiles.get((z, x, y), lambda: _build_tile(z, x, y))
+
+
+def _build_tile(z, x, y):
+    min_x, min_y, max_x, max_y = tile_bounds(z, x, y)
+    tolerance = select_tolerance(zoom=z)
+
+    params = {"min_x": min_x, "min_y": min_y, "max_x": max_x, "max_y": max_y}
+
+    if tolerance == FULL_RESOLUTION:
+        query = TILE_QUERY.format(communities=FULL_RESOLUTION_COMMUNITIES)
+    else:
+        query = TILE_QUERY.format(communities=SIMPLIFIED_COMMUNITIES)
+        params["tolerance"] = tolerance
+
+    tile = db.session.execute(query, params).scalar()
+
+    return Payload(bytes(tile), mimetype=MVT_MIMETYPE)
@@ -1,15 +1,36 @@
 import os
+import csv
+
+import click
 
 from app import create_app, db
 from app.models.community_resource import CommunityResource
 from app.models.community import Community
 from app.models.user import User
+from app.models.resource_cluster import ResourceCluster
+from app.models.simplified_boundaries import SimplifiedBoundaries
+from app.models.geocode_cache import GeocodeCache
+from app.models.outbox_email import OutboxEmail
+from app import mailer
 from tests import CommunityResourceFactory
 from geoalchemy2 import WKTElement
 
 # Expose flask application from inside connexion.
 application = create_app(os.environ.get("DANA_CONFIG", "development")).app
 
+# Columns and indexes added to tables which may already exist, which
+# db.create_all does not alter.  Applied by upgrade_db, and safe to repeat.
+UPGRADE_STATEMENTS = [
+    "ALTER TABLE community_resources ADD COLUMN IF NOT EXISTS geojson JSON",
+    "ALTER TABLE community_resources ADD COLUMN IF NOT EXISTS document TEXT",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE resource_clusters ADD COLUMN IF NOT EXISTS centroid_point geometry(POINT, 4326)",
+    "CREATE INDEX IF NOT EXISTS idx_resource_clusters_centroid_point ON resource_clusters USING GIST (centroid_point)",
+    # Emails are unique regardless of case
+    "DROP INDEX IF EXISTS ix_users_email",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_users_email_lower ON users (lower(email))"
+]
+
 
 @application.cli.command(with_appcontext=True)
 def create_db():
@@ -17,6 +38,30 @@ def create_db():
     """
     db.engine.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
     db.create_all()
+    CommunityResource.create_indexes()
+    Community.create_indexes()
+    ResourceCluster.create_indexes()
+    CommunityResource.refresh_documents()
+    ResourceCluster.rebuild()
+    db.session.commit()
+
+
+@application.cli.command(with_appcontext=True)
+def upgrade_db():
+    """Bring the tables of an existing database up to date with the SQLAlchemy
+    models, keeping their rows, and rebuild the data derived from them.
+    """
+    db.engine.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+    db.create_all()
+    for statement in UPGRADE_STATEMENTS:
+        db.engine.execute(statement)
+    CommunityResource.create_indexes()
+    Community.create_indexes()
+    ResourceCluster.create_indexes()
+    CommunityResource.refresh_documents()
+    ResourceCluster.rebuild()
+    SimplifiedBoundaries.simplify_community()
+    db.session.commit()
 
 
 @application.cli.command(with_appcontext=True)
@@ -28,8 +73,58 @@ def drop_db():
 
 
 @application.cli.command(with_appcontext=True)
-def populate_db():
+@click.option("--force", is_flag=True, help="Re-read datasets even if their files have not changed.")
+def populate_db(force):
     """Populate database with default data.
     """
-    CommunityResource.populate_db()
-    Community.populate_db()
\ No newline at end of file
+    CommunityResource.populate_db(force)
+    Community.populate_db(force)
+    # Refresh planner statistics for the newly loaded rows.
+    CommunityResource.create_indexes()
+    Community.create_indexes()
+
+
+@application.cli.command(with_appcontext=True)
+def clear_geocode_cache():
+    """Delete expired entries from the geocoding cache.
+    """
+    GeocodeCache.clear_expired()
+
+
+@application.cli.command(with_appcontext=True)
+def geocode_resources():
+    """Move every community resource with an address to its geocoded location.
+    """
+    count = CommunityResource.geocode_resources()
+    db.session.commit()
+    print("{} community resources geocoded".format(count))
+
+
+@application.cli.command(with_appcontext=True)
+@click.option("--once", is_flag=True, help="Send the queued emails and exit.")
+def mail_worker(once):
+    """Send queued emails until interrupted.
+    """
+    mailer.run_worker(once)
+
+
+@application.cli.command(with_appcontext=True)
+def mail_status():
+    """Print the number of queued emails and the age of the oldest.
+    """
+    depth, oldest = OutboxEmail.queue_depth()
+    print("{} emails queued".format(depth))
+    if oldest is not None:
+        print("oldest queued {:.0f}s ago".format(oldest))
+
+
+@application.cli.command(with_appcontext=True)
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_users(path):
+    """Add users from a CSV file with email, password and optional role columns.
+    """
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    count = User.import_users(rows)
+    print("{} users imported, {} skipped".format(count, len(rows) - count))
@@ -16,6 +16,74 @@ class Config():
     SECRET_KEY = os.environ.get("SECRET_KEY", "secret-key")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = "postgres+pg8000://postgres:test@db/postgres"
+    # Seconds between checks for changes to data cached in memory.
+    DATA_VERSION_TTL = int(os.environ.get("DATA_VERSION_TTL", 30))
+    # Seconds clients and shared caches may reuse a vector tile without revalidating it.
+    TILE_MAX_AGE = int(os.environ.get("TILE_MAX_AGE", 60))
+    # Seconds geocoded addresses, and addresses which could not be geocoded, are cached.
+    GEOCODE_CACHE_TTL = int(os.environ.get("GEOCODE_CACHE_TTL", 30 * 24 * 60 * 60))
+    GEOCODE_NEGATIVE_CACHE_TTL = int(os.environ.get("GEOCODE_NEGATIVE_CACHE_TTL", 60 * 60))
+    # Geocoding backend, one of "nominatim", "gazetteer" or "fake".
+    GEOCODER = os.environ.get("GEOCODER", "nominatim")
+    # Maximum geocoder lookups per second across all threads, or 0 for no limit.
+    GEOCODER_RATE_LIMIT = float(os.environ.get("GEOCODER_RATE_LIMIT", 1))
+    GEOCODER_WORKERS = int(os.environ.get("GEOCODER_WORKERS", 4))
+    # Point shapefiles the offline gazetteer geocoder is built from.
+    GEOCODER_GAZETTEER_PATHS = ["/db_info/shelters/shelters_wgs84.shp", "/db_info/dropins/TDIN_wgs84.shp"]
+    # Cache the responses of public GET endpoints until their data is written.
+    RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "1") == "1"
+    # Cache shared by every process: "" for none, "local" for an in-process
+    # stand-in, or a redis:// URL.  Entries expire after RESPONSE_CACHE_TTL seconds.
+    RESPONSE_CACHE_SHARED = os.environ.get("RESPONSE_CACHE_SHARED", "")
+    RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 10 * 60))
+    # Limits on the polygons clients search within.  Polygons with more than
+    # POLYGON_SIMPLIFY_VERTICES vertices are simplified to
+    # POLYGON_SIMPLIFY_TOLERANCE degrees before searching.
+    POLYGON_MAX_VERTICES = int(os.environ.get("POLYGON_MAX_VERTICES", 1000))
+    POLYGON_MAX_AREA = float(os.environ.get("POLYGON_MAX_AREA", 1.0))
+    POLYGON_SIMPLIFY_VERTICES = int(os.environ.get("POLYGON_SIMPLIFY_VERTICES", 200))
+    POLYGON_SIMPLIFY_TOLERANCE = float(os.environ.get("POLYGON_SIMPLIFY_TOLERANCE", 0.0001))
+    # Seconds a request waits for an identical request's query to finish
+    # before running the query itself.
+    SINGLE_FLIGHT_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_TIMEOUT", 10))
+    # Degrees per side of the grid cells resource radius searches are cached by,
+    # or 0 to query the database for every search.
+    SEARCH_CELL_SIZE = float(os.environ.get("SEARCH_CELL_SIZE", 0))
+    # "claims" to authenticate tokens from their verified claims alone, or
+    # "database" to load the user on every token-authenticated request.
+    TOKEN_AUTH_MODE = os.environ.get("TOKEN_AUTH_MODE", "claims")
+    # Werkzeug password hash method, and iterations for pbkdf2 methods.  Stored
+    # hashes with other parameters are upgraded on the user's next login.
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256")
+    PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", 50000))
+    # Threads hashing new passwords, bounding the CPU spent on signups, or 0 to
+    # hash on the request thread.
+    PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 4))
+    # Link emailed to new users, formatted with their email_hash.
+    ACTIVATION_URL = os.environ.get("ACTIVATION_URL", "http://localhost:5000/user/activate?email_hash={email_hash}")
+    # SMTP server the mail worker sends queued emails through.
+    MAIL_SERVER = os.environ.get("MAIL_SERVER", "localhost")
+    MAIL_PORT = int(os.environ.get("MAIL_PORT", 25))
+    MAIL_USE_TLS = os.environ.get("MAIL_USE_TLS", "") == "1"
+    MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
+    MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+    MAIL_SENDER = os.environ.get("MAIL_SENDER", "noreply@danacharityproject.org")
+    # Open SMTP connections, emails claimed per batch and seconds between polls.
+    MAIL_SMTP_POOL_SIZE = int(os.environ.get("MAIL_SMTP_POOL_SIZE", 2))
+    MAIL_BATCH_SIZE = int(os.environ.get("MAIL_BATCH_SIZE", 50))
+    MAIL_POLL_INTERVAL = float(os.environ.get("MAIL_POLL_INTERVAL", 5))
+    # Failed emails are retried after MAIL_RETRY_BACKOFF seconds, doubling up to
+    # MAIL_RETRY_BACKOFF_MAX, and given up on after MAIL_MAX_ATTEMPTS attempts.
+    MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", 8))
+    MAIL_RETRY_BACKOFF = int(os.environ.get("MAIL_RETRY_BACKOFF", 30))
+    MAIL_RETRY_BACKOFF_MAX = int(os.environ.get("MAIL_RETRY_BACKOFF_MAX", 60 * 60))
+    # Seconds a verified Basic auth email and password are trusted without
+    # rehashing the password, or 0 to always rehash.
+    CREDENTIAL_CACHE_TTL = int(os.environ.get("CREDENTIAL_CACHE_TTL", 60))
+    # Shapefile records read and written per batch by populate_db.
+    INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 500))
+    # Processes parsing shapefile records for populate_db, or 0 to parse in-process.
+    INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 0))
 
 
 class DevelopmentConfig(Config):
@@ -24,6 +92,15 @@ class DevelopmentConfig(Config):
 
 class TestingConfig(Config):
     TESTING = True
+    DATA_VERSION_TTL = 0
+    # Cached credentials name a user id, and ids restart with every test's
+    # fresh database.
+    CREDENTIAL_CACHE_TTL = 0
+    # Each test recreates the database, so ids and versions are reused.  The
+    # response cache's shared tier is off for the same reason.
+    RESPONSE_CACHE_SHARED = ""
+    GEOCODER = "fake"
+    GEOCODER_RATE_LIMIT = 0
     SQLALCHEMY_DATABASE_URI = "postgres+pg8000://postgres:test@db/postgres"
 
 
@@ -6,11 +6,14 @@ import os
 import pytest
 import pygeoif
 
-from app import create_app, db
+from app import create_app, db, tiles
 import app.models as models
-from app.models.user import User
+from app.models.user import User, USER_ROLE_USER, USER_ROLE_ADMIN
 from app.models.community_resource import CommunityResource
-from app.models.community import Community
+from app.models.community import Community, COMMUNITY_DATA_VERSION
+from app.models.geocode_cache import GeocodeCache
+from app.cache import invalidate
+from app.models.outbox_email import OutboxEmail
 from geoalchemy2.elements import WKTElement
 
 import random
@@ -112,6 +115,73 @@ def test_get_user_token(client):
     return_email = models.user.User.verify_auth_token(body["token"]).email
     assert return_email == user.email
 
+    # authenticate with the token
+    token_headers = get_headers()
+    token_headers["Authorization"] = "Bearer " + body["token"]
+    rv = client.get("/user", headers=token_headers)
+    assert rv.status_code == 200
+    assert json.loads(rv.get_data(as_text=True))["email"] == email
+
+    # the activation hash is signed too, but is not an auth token
+    hash_headers = get_headers()
+    hash_headers["Authorization"] = "Bearer " + email_hash
+    rv = client.get("/user", headers=hash_headers)
+    assert rv.status_code == 401
+
+    # changing the password revokes the token
+    rv = client.put("/user/password", headers=token_headers, data=json.dumps({
+        "password": "DYsr2!4Fksh"
+    }))
+    assert rv.status_code == 200
+    rv = client.get("/user", headers=token_headers)
+    assert rv.status_code == 401
+
+
+def test_add_user_case_insensitive(client):
+    result = User.add_user(User.from_dict({
+        "email": "Foo@example.com",
+        "password": "bar"
+    }))
+    assert result is not None
+    assert result[0].user_id is not None
+    assert result[0].role == USER_ROLE_USER
+    # the activation email is queued
+    queued = OutboxEmail.query.filter_by(recipient="foo@example.com").one()
+    assert result[1] in queued.body
+
+    # emails are unique regardless of case
+    assert User.add_user(User.from_dict({
+        "email": "FOO@example.com",
+        "password": "baz"
+    })) is None
+    assert User.get_user_by_email("foo@EXAMPLE.com").verify_password("bar")
+
+
+def test_import_users(client):
+    User.add_user(User.from_dict({
+        "email": "taken@example.com",
+        "password": "bar"
+    }))
+
+    count = User.import_users([
+        {"email": "a@example.com", "password": "bar"},
+        {"email": "B@example.com", "password": "bar", "role": USER_ROLE_ADMIN},
+        {"email": "b@example.com", "password": "baz"},
+        {"email": "Taken@example.com", "password": "baz"},
+        {"email": "invalid", "password": "bar"},
+        {"email": "c@example.com", "password": "bar", "role": "superuser"},
+        {"email": "d@example.com", "password": ""},
+        {"email": "e@example.com"}
+    ], batch_size=2)
+
+    assert count == 2
+    assert User.get_user_by_email("b@example.com").role == USER_ROLE_ADMIN
+    assert User.get_user_by_email("taken@example.com").verify_password("bar")
+    assert User.get_user_by_email("invalid") is None
+    assert User.get_user_by_email("c@example.com") is None
+    assert User.get_user_by_email("d@example.com") is None
+    assert User.get_user_by_email("e@example.com") is None
+
 
 def test_get_user_activation(client):
     email = "foo"
@@ -291,17 +361,117 @@ def test_get_communityresource_list(client):
         "image_uri": image_uri3
     }))
 
-    # coordinates close to charities 1 and 3
-    y = 44.4076
-    x = -76.0180
-    radius = 200
+    # coordinates close to charities 1 and 3, closer to charity 3
+    y = -79.39780
+    x = 43.70350
+    radius = 2
     rv = client.get("/communityresource?longitude={longitude}&latitude={latitude}&radius={radius}".format(longitude=x, latitude=y, radius=radius), headers=get_headers())
 
     body = json.loads(rv.get_data(as_text=True))
 
     assert rv.status_code == 200
     assert len(body) == 2
-    assert body[0]['community_resource_id'] == 1 and body[1]['community_resource_id'] == 3
+    assert body[0]['community_resource_id'] == 3 and body[1]['community_resource_id'] == 1
+    # distances are in kilometers
+    assert 0 < body[0]['distance'] < body[1]['distance'] < radius
+
+    # radius is in kilometers, not degrees
+    rv = client.get("/communityresource?longitude={longitude}&latitude={latitude}&radius={radius}".format(longitude=x, latitude=y, radius=0.05), headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert len(body) == 0
+
+
+def test_get_communityresource_nearest(client):
+    SRID = "SRID=4326;"
+
+    # charity number, name, coordinates
+    resources = [
+        ("1000", "The Mission", SRID + "POINT(43.70649 -79.39806)"),
+        ("2000", "Far Charity", SRID + "POINT(38.88763 -119.98271)"),
+        ("3000", "Another Close Charity", SRID + "POINT(43.70273 -79.39770)")
+    ]
+
+    for (charity_number, name, coordinates) in resources:
+        CommunityResource.add_community_resource(CommunityResource.from_dict({
+            "charity_number": charity_number,
+            "name": name,
+            "address": "1 Yonge Street",
+            "coordinates": coordinates,
+            "contact_name": "John Smith",
+            "email": "foo123@mail.com",
+            "phone_number": "4161234567",
+            "website": "www.test.com",
+            "image_uri": "http://www.google.com/image.png"
+        }))
+
+    # coordinates close to charities 1 and 3, closer to charity 3
+    y = -79.39780
+    x = 43.70350
+    rv = client.get("/communityresource?longitude={longitude}&latitude={latitude}&limit={limit}".format(longitude=x, latitude=y, limit=2), headers=get_headers())
+
+    body = json.loads(rv.get_data(as_text=True))
+
+    assert rv.status_code == 200
+    assert len(body) == 2
+    assert body[0]['community_resource_id'] == 3 and body[1]['community_resource_id'] == 1
+    assert body[0]['distance'] < body[1]['distance']
+
+    # the far charity is returned when enough results are requested
+    rv = client.get("/communityresource?longitude={longitude}&latitude={latitude}&limit={limit}".format(longitude=x, latitude=y, limit=10), headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert [resource['community_resource_id'] for resource in body] == [3, 1, 2]
+
+
+def test_get_communityresource_clusters(client):
+    SRID = "SRID=4326;"
+
+    # charity number, name, coordinates
+    resources = [
+        ("1000", "The Mission", SRID + "POINT(43.70649 -79.39806)"),
+        ("2000", "Far Charity", SRID + "POINT(38.88763 -119.98271)"),
+        ("3000", "Another Close Charity", SRID + "POINT(43.70273 -79.39770)")
+    ]
+
+    for (charity_number, name, coordinates) in resources:
+        CommunityResource.add_community_resource(CommunityResource.from_dict({
+            "charity_number": charity_number,
+            "name": name,
+            "address": "1 Yonge Street",
+            "coordinates": coordinates,
+            "contact_name": "John Smith",
+            "email": "foo123@mail.com",
+            "phone_number": "4161234567",
+            "website": "www.test.com",
+            "image_uri": "http://www.google.com/image.png"
+        }))
+
+    # charities 1 and 3 share a cell when zoomed out
+    rv = client.get("/communityresource?longitude={}&latitude={}&radius={}&cluster=grid&zoom={}".format(43.7035, -79.3978, 5, 8), headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert len(body) == 1
+    assert body[0]['count'] == 2
+    assert body[0]['location']['coordinates'] == [(43.70649 + 43.70273) / 2, (-79.39806 + -79.39770) / 2]
+
+    # and are separate when zoomed in
+    rv = client.get("/communityresource?longitude={}&latitude={}&radius={}&cluster=grid&zoom={}".format(43.7035, -79.3978, 5, 18), headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert sorted(cluster['count'] for cluster in body) == [1, 1]
+
+    # cluster requires a zoom level
+    rv = client.get("/communityresource?longitude={}&latitude={}&radius={}&cluster=grid".format(43.7035, -79.3978, 5), headers=get_headers())
+    assert rv.status_code == 400
+
+    # clusters follow edits
+    CommunityResource.edit_community_resource(3, "Another Close Charity", 38.89, -119.98, "Pat", "foo789@mail.com", "4162564587", "2 Yonge Street", "www.anothercharity.com", "http://www.google.com/image3.png")
+    polygon_string = "POLYGON((30 -130,30 -70,50 -70,50 -130,30 -130))"
+    rv = client.get("/communityresource?polygon_string={}&cluster=grid&zoom={}".format(polygon_string, 0), headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert sum(cluster['count'] for cluster in body) == 3
 
 
 def test_get_communityresource_in_shape(client):
@@ -364,6 +534,11 @@ def test_get_communityresource_in_shape(client):
     assert body[0]['community_resource_id'] == 1
     assert body[1]['community_resource_id'] == 2
 
+    # malformed and oversized polygons are rejected
+    for polygon_string in ["POLYGON((43.66 -79.39, 43.67 -79.39))", "POLYGON((0 0,0 10,10 10,10 0,0 0))"]:
+        rv = client.get("/communityresource?polygon_string={polygon_string}".format(polygon_string=polygon_string), headers=get_headers())
+        assert rv.status_code == 400
+
 def test_get_community_resource_info(client):
     SRID = "SRID=4326;"
 
@@ -402,6 +577,25 @@ def test_get_community_resource_info(client):
     rv = client.get("/communityresource/{community_resource_id}".format(community_resource_id=2, headers=get_headers()))
     assert rv.status_code == 404
 
+    # batch of details, in the order given, skipping missing resources
+    CommunityResource.add_community_resource(CommunityResource.from_dict({
+        "charity_number": "2000",
+        "name": "Another Mission",
+        "address": address,
+        "coordinates": coordinates,
+        "contact_name": contact_name,
+        "email": email,
+        "phone_number": phone_number,
+        "website": website,
+        "image_uri": image_uri
+    }))
+    rv = client.get("/communityresource?ids=2,5,1", headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert [community_resource["id"] for community_resource in body] == [2, 1]
+    assert body[1]["charity_number"] == int(charity_number)
+    assert json.loads(body[1]["coordinates"][0])["coordinates"] == [43.70649, -79.39806]
+
 
 def test_community_resource_populate_db(client):
     CommunityResource.populate_db()
@@ -575,6 +769,71 @@ def test_put_community_resource_info(client):
     assert rv.status_code == 400 # working
 
 
+def test_geocoded_community_resource_radius_search(client):
+    # resources are stored at their geocoded address the way
+    # post_communityresource and put_communityresource store them
+    resource = CommunityResource.add_community_resource(CommunityResource.from_dict({
+        "charity_number": "1000",
+        "name": "The Mission",
+        "address": "1 Yonge Street",
+        "coordinates": CommunityResource.coordinates_from_address("1 Yonge Street"),
+        "contact_name": "John Smith",
+        "email": "foo123@mail.com",
+        "phone_number": "4161234567",
+        "website": "www.test.com",
+        "image_uri": "http://www.google.com/image.png"
+    }))
+
+    # and are found near it, searched by (latitude, longitude) like every
+    # other stored resource
+    longitude, latitude = CommunityResource.geocode_address("1 Yonge Street")
+    rv = client.get("/communityresource?longitude={}&latitude={}&radius={}".format(latitude, longitude, 0.1), headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert [resource["name"] for resource in body] == ["The Mission"]
+
+    # including after they are moved
+    longitude, latitude = CommunityResource.geocode_address("2 Bloor Ave")
+    CommunityResource.edit_community_resource(resource.community_resource_id, "The Mission", latitude, longitude, "John Smith", "foo123@mail.com", "4161234567", "2 Bloor Ave", "www.test.com", "http://www.google.com/image.png")
+
+    rv = client.get("/communityresource?longitude={}&latitude={}&radius={}".format(latitude, longitude, 0.1), headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert [resource["name"] for resource in body] == ["The Mission"]
+
+def test_geocode_resources(client):
+    longitude, latitude = CommunityResource.geocode_address("1 Yonge Street")
+    # stored in the wrong axis order
+    CommunityResource.add_community_resource(CommunityResource.from_dict({
+        "charity_number": "1000",
+        "name": "The Mission",
+        "address": "1 Yonge Street",
+        "coordinates": CommunityResource.long_lat_to_point(longitude, latitude),
+        "contact_name": "John Smith",
+        "email": "foo123@mail.com",
+        "phone_number": "4161234567",
+        "website": "www.test.com",
+        "image_uri": "http://www.google.com/image.png"
+    }))
+
+    assert CommunityResource.geocode_resources() == 1
+    db.session.commit()
+
+    rv = client.get("/communityresource?longitude={}&latitude={}&radius={}".format(latitude, longitude, 0.1), headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert [resource["name"] for resource in body] == ["The Mission"]
+
+def test_geocode_cache_keeps_caller_transaction(client):
+    db.session.add(User.from_dict({"email": "pending@example.com", "password": "bar"}))
+
+    # the cached lookup is stored without committing the caller's changes
+    coordinates = GeocodeCache.geocode("3 Yonge Street")
+    db.session.rollback()
+
+    assert User.get_user_by_email("pending@example.com") is None
+    assert GeocodeCache.query.get("3 yonge street").coordinates == coordinates
+
 @pytest.mark.skip
 def test_post_community_resource_info(client):
     charity_number = "0000"
@@ -655,6 +914,98 @@ def test_get_all_communities(client):
     print(body[0]["boundaries"])
     assert body[0]["boundaries"] == expected_boundaries
 
+    # unchanged communities are not sent again
+    etag = rv.headers["ETag"]
+    rv = client.get("/community", headers=dict(get_headers(), **{"If-None-Match": etag}))
+    assert rv.status_code == 304
+
+    # adding a community changes the payload
+    Community.add_comunity(Community.from_dict({
+        "id": 2,
+        "name": "Another community",
+        "boundaries": boundaries
+    }))
+    rv = client.get("/community", headers=dict(get_headers(), **{"If-None-Match": etag}))
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert len(body) == 2
+    assert rv.headers["ETag"] != etag
+
+    # communities which have not been simplified are sent at full resolution
+    db.session.execute("DELETE FROM simplified_boundaries WHERE community_id = 2")
+    invalidate(COMMUNITY_DATA_VERSION)
+    db.session.commit()
+    rv = client.get("/community?zoom=10", headers=get_headers())
+    body = json.loads(rv.get_data(as_text=True))
+    assert rv.status_code == 200
+    assert [community["id"] for community in sorted(body, key=lambda community: community["id"])] == [1, 2]
+    assert [community for community in body if community["id"] == 2][0]["boundaries"] == expected_boundaries
+
+
+def test_get_tile(client):
+    CommunityResource.add_community_resource(CommunityResource.from_dict({
+        "charity_number": "1000",
+        "name": "The Mission",
+        "address": "1 Yonge Street",
+        "coordinates": "SRID=4326;POINT(43.70649 -79.39806)",
+        "contact_name": "John Smith",
+        "email": "foo123@mail.com",
+        "phone_number": "4161234567",
+        "website": "www.test.com",
+        "image_uri": "http://www.google.com/image.png"
+    }))
+
+    # the tile containing the resource
+    rv = client.get("/tiles/12/1144/1494.mvt")
+    assert rv.status_code == 200
+    assert rv.mimetype == "application/vnd.mapbox-vector-tile"
+    assert b"community_resources" in rv.get_data()
+    etag = rv.headers["ETag"]
+
+    rv = client.get("/tiles/12/1144/1494.mvt", headers={"If-None-Match": etag})
+    assert rv.status_code == 304
+
+    # a tile on the other side of the world
+    rv = client.get("/tiles/12/0/0.mvt")
+    assert rv.status_code == 200
+    assert b"community_resources" not in rv.get_data()
+
+    # tiles are rebuilt when resources change
+    CommunityResource.add_community_resource(CommunityResource.from_dict({
+        "charity_number": "3000",
+        "name": "Another Close Charity",
+        "address": "2 Yonge Street",
+        "coordinates": "SRID=4326;POINT(43.70273 -79.39770)",
+        "contact_name": "Pat",
+        "email": "foo789@mail.com",
+        "phone_number": "4162564587",
+        "website": "www.anothercharity.com",
+        "image_uri": "http://www.google.com/image3.png"
+    }))
+    rv = client.get("/tiles/12/1144/1494.mvt", headers={"If-None-Match": etag})
+    assert rv.status_code == 200
+    assert b"Another Close Charity" in rv.get_data()
+
+    # resources stored at a geocoded address are drawn in the tile containing it
+    CommunityResource.add_community_resource(CommunityResource.from_dict({
+        "charity_number": "4000",
+        "name": "Geocoded Charity",
+        "address": "100 Queen Street West",
+        "contact_name": "Sam",
+        "email": "foo456@mail.com",
+        "phone_number": "4162564588",
+        "website": "www.geocoded.com",
+        "image_uri": "http://www.google.com/image4.png"
+    }))
+    x, y = tiles.tile_containing(12, *CommunityResource.geocode_address("100 Queen Street West"))
+    rv = client.get("/tiles/12/{}/{}.mvt".format(x, y))
+    assert rv.status_code == 200
+    assert b"Geocoded Charity" in rv.get_data()
+
+    # tile does not exist
+    rv = client.get("/tiles/1/5/5.mvt")
+    assert rv.status_code == 404
+
 
 def test_community_populate_db(client):
     Community.populate_db()
@@ -671,6 +1022,14 @@ def test_community_populate_db(client):
     boundaries = body[0]['boundaries']
     assert boundaries == expected_boundaries
 
+    # overview maps get fewer vertices
+    rv = client.get("/community?zoom=10", headers=get_headers())
+    assert rv.status_code == 200
+    body = json.loads(rv.get_data(as_text=True))
+    assert body[0]['id'] == expected_id
+    simplified = body[0]['boundaries']['coordinates']
+    assert 4 <= len(simplified[0][0]) < len(expected_boundaries['coordinates'][0][0])
+
 
 def test_community_query_community_containing(client):
     community_id = 1
@@ -696,6 +1055,15 @@ def test_community_query_community_containing(client):
     assert body['name'] == name
     assert json.loads(body['boundaries'])['coordinates'] == expected_boundaries
 
+    # simplified boundaries still contain the community's corners
+    rv = client.get("/community/search?longitude={}&latitude={}&zoom={}".format(point_lat, point_long, 0), headers=get_headers())
+    assert rv.status_code == 200
+    body = json.loads(rv.get_data(as_text=True))
+    assert body['id'] == community_id
+    simplified = json.loads(body['boundaries'])['coordinates']
+    assert len(simplified[0][0]) <= len(expected_boundaries[0][0])
+    assert simplified[0][0][0] == expected_boundaries[0][0][0]
+
     rv = client.get("/community/search?longitude={}&latitude={}".format(43, 79), headers=get_headers())
     assert rv.status_code ==  200
     assert rv.get_data(as_text=True) is ''
@@ -0,0 +1,40 @@
+from unittest.mock import patch
+
+from flask import g
+
+from app import create_app, auth
+from app.models.user import User
+
+
+@patch("app.auth.User.get_token_version")
+@patch("app.auth.User.get_user_by_email")
+def test_verify_password_cache(mock_get_user_by_email, mock_get_token_version):
+    app = create_app("testing").app
+    app.config["CREDENTIAL_CACHE_TTL"] = 60
+    auth._credential_cache.clear()
+
+    user = User(user_id=1, email="foo", role="user", token_version=0)
+    user.password = "bar"
+    mock_get_user_by_email.return_value = user
+    mock_get_token_version.return_value = 0
+
+    with app.test_request_context():
+        assert auth.verify_password("foo", "bar")
+        assert mock_get_user_by_email.call_count == 1
+
+        # verified credentials are cached
+        assert auth.verify_password("FOO", "bar")
+        assert mock_get_user_by_email.call_count == 1
+        assert g.current_user_id == 1
+        assert g.current_role == "user"
+
+        # incorrect passwords are never cached
+        assert not auth.verify_password("foo", "baz")
+        assert not auth.verify_password("foo", "baz")
+        assert mock_get_user_by_email.call_count == 3
+
+        # a changed password or role discards the cached credentials
+        mock_get_token_version.return_value = 1
+        user.password = "new"
+        assert not auth.verify_password("foo", "bar")
+        assert mock_get_user_by_email.call_count == 4
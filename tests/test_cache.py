@@ -0,0 +1,125 @@
+import concurrent.futures
+import gzip
+import threading
+import time
+
+import pytest
+
+from flask import Flask, request
+
+from app import cache
+
+app = Flask(__name__)
+
+
+def test_payload_make_response():
+    body = b'[{"id": 1}]'
+    payload = cache.Payload(body)
+
+    # No accepted encodings
+    with app.test_request_context("/"):
+        rv = payload.make_response(request)
+        assert rv.status_code == 200
+        assert rv.get_data() == body
+        assert rv.mimetype == "application/json"
+        assert "Content-Encoding" not in rv.headers
+        assert rv.get_etag() == (payload.etag, False)
+
+    # Compressed
+    with app.test_request_context("/", headers={"Accept-Encoding": "gzip"}):
+        rv = payload.make_response(request)
+        assert rv.status_code == 200
+        assert rv.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(rv.get_data()) == body
+        assert rv.get_etag() == (payload.etag + "-gzip", False)
+
+    # Client copy is current
+    with app.test_request_context("/", headers={"If-None-Match": '"' + payload.etag + '"'}):
+        rv = payload.make_response(request)
+        assert rv.status_code == 304
+        assert rv.get_data() == b""
+
+    # Client copy is stale
+    with app.test_request_context("/", headers={"If-None-Match": '"abc"'}):
+        rv = payload.make_response(request)
+        assert rv.status_code == 200
+
+
+def test_lru_cache():
+    lru_cache = cache.LRUCache(2)
+
+    lru_cache.set("a", 1, 60)
+    lru_cache.set("b", 2, 60)
+    assert lru_cache.get("a") == 1
+    # "b" is the least recently used
+    lru_cache.set("c", 3, 60)
+    assert lru_cache.get("b") is None
+    assert lru_cache.get("c") == 3
+    assert len(lru_cache) == 2
+    # expired entries are not returned
+    lru_cache.set("d", 4, 0)
+    assert lru_cache.get("d", "missing") == "missing"
+    # None can be cached
+    lru_cache.set("e", None, 60)
+    assert lru_cache.get("e", "missing") is None
+
+    assert lru_cache.hits == 3
+    assert lru_cache.misses == 2
+
+
+def test_single_flight():
+    flights = cache.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_query():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "result"
+
+    leader = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    first = leader.submit(flights.do, "key", slow_query)
+    started.wait()
+    # identical concurrent calls share the running call
+    followers = [leader.submit(flights.do, "key", slow_query, 5) for _ in range(2)]
+    while flights.coalesced < 2:
+        time.sleep(0.01)
+    release.set()
+
+    assert first.result() == "result"
+    assert [follower.result() for follower in followers] == ["result", "result"]
+    assert len(calls) == 1
+
+    # the call has finished, so the next one runs again
+    assert flights.do("key", lambda: "again") == "again"
+
+
+def test_single_flight_fallback():
+    flights = cache.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def stuck():
+        started.set()
+        release.wait()
+        raise ValueError()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    first = executor.submit(flights.do, "key", stuck)
+    started.wait()
+
+    # waiting calls which time out run the function themselves
+    assert flights.do("key", lambda: "fallback", timeout=0.01) == "fallback"
+    assert flights.timeouts == 1
+
+    # as do waiting calls whose shared call fails
+    follower = executor.submit(flights.do, "key", lambda: "recovered")
+    while flights.coalesced < 2:
+        time.sleep(0.01)
+    release.set()
+
+    with pytest.raises(ValueError):
+        first.result()
+    assert follower.result() == "recovered"
@@ -0,0 +1,64 @@
+import os
+import time
+
+import pytest
+
+from app import geocoders
+
+DB_INFO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "db_info")
+
+
+def test_fake_geocoder():
+    geocoder = geocoders.FakeGeocoder()
+    min_longitude, min_latitude, max_longitude, max_latitude = geocoders.FAKE_GEOCODER_BOUNDS
+
+    longitude, latitude = geocoder.geocode("1 Yonge St")
+    assert min_longitude <= longitude <= max_longitude
+    assert min_latitude <= latitude <= max_latitude
+    # Deterministic for equivalent addresses
+    assert geocoder.geocode("1 yonge st.") == (longitude, latitude)
+    assert geocoder.geocode("2 Yonge St") != (longitude, latitude)
+    # Empty addresses cannot be geocoded
+    assert geocoder.geocode(" ") is None
+
+
+def test_gazetteer_geocoder():
+    geocoder = geocoders.GazetteerGeocoder([
+        os.path.join(DB_INFO, "shelters", "shelters_wgs84.shp"),
+        os.path.join(DB_INFO, "dropins", "TDIN_wgs84.shp"),
+        os.path.join(DB_INFO, "missing.shp")
+    ])
+
+    # Shelter address
+    longitude, latitude = geocoder.geocode("70 Gerrard St. E, Toronto")
+    assert round(longitude, 1) == -79.4 and round(latitude, 1) == 43.7
+    # Drop-in address
+    assert geocoder.geocode("107 Jarvis St") is not None
+    assert geocoder.geocode("1 Nowhere Rd") is None
+
+
+def test_gazetteer_geocoder_without_addresses():
+    with pytest.raises(ValueError):
+        geocoders.GazetteerGeocoder([os.path.join(DB_INFO, "communities", "NEIGHBORHOODS_WGS84.shp")])
+
+
+def test_geocoder_is_abstract():
+    with pytest.raises(TypeError):
+        geocoders.Geocoder()
+
+
+def test_geocode_many():
+    geocoder = geocoders.FakeGeocoder(workers=4)
+    addresses = ["{} Yonge St".format(number) for number in range(20)]
+
+    assert geocoder.geocode_many(addresses) == [geocoder.geocode(address) for address in addresses]
+
+
+def test_rate_limiter():
+    rate_limiter = geocoders.RateLimiter(50)
+
+    start = time.monotonic()
+    for _ in range(6):
+        rate_limiter.wait()
+    # The first call is immediate, the rest are spaced 20ms apart
+    assert time.monotonic() - start >= 0.1
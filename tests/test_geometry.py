@@ -0,0 +1,141 @@
+import struct
+
+import pytest
+from unittest.mock import patch
+
+from app import geometry
+
+# A square with a square hole, and a separate triangle.
+SQUARE_WITH_HOLE = [
+    [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+    [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+]
+TRIANGLE = [[[20, 0], [30, 0], [25, 10], [20, 0]]]
+
+
+def test_prepared_multipolygon_contains():
+    polygon = geometry.PreparedMultiPolygon([SQUARE_WITH_HOLE, TRIANGLE])
+
+    assert polygon.box == (0, 0, 30, 10)
+    # Inside the square
+    assert polygon.contains(2, 2)
+    # Inside the hole
+    assert not polygon.contains(5, 5)
+    # Inside the triangle
+    assert polygon.contains(25, 5)
+    # Between the parts, inside the bounding box
+    assert not polygon.contains(15, 5)
+    # Outside the bounding box
+    assert not polygon.contains(-1, 5)
+
+
+def test_bounding_box_tree_query_point():
+    # A 20 x 20 grid of unit squares
+    items = [((x, y, x + 1, y + 1), (x, y)) for x in range(20) for y in range(20)]
+    tree = geometry.BoundingBoxTree(items)
+
+    assert len(tree) == 400
+    assert list(tree.query_point(3.5, 17.5)) == [(3, 17)]
+    assert sorted(tree.query_point(3, 17.5)) == [(2, 17), (3, 17)]
+    assert list(tree.query_point(-1, -1)) == []
+    assert list(geometry.BoundingBoxTree([]).query_point(0, 0)) == []
+
+
+def test_shapefile_polygons():
+    # Clockwise outer rings, each followed by its counter-clockwise holes
+    outer = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+    hole = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+    second_outer = [[20, 0], [25, 10], [30, 0], [20, 0]]
+    buffer = geometry.coordinate_buffer(outer + hole + second_outer)
+
+    polygons = geometry.shapefile_polygons(buffer, [0, 5, 10])
+
+    assert [[list(ring) for ring in polygon] for polygon in polygons] == [
+        [list(geometry.coordinate_buffer(outer)), list(geometry.coordinate_buffer(hole))],
+        [list(geometry.coordinate_buffer(second_outer))]
+    ]
+
+
+def test_swap_axes():
+    assert list(geometry.swap_axes(geometry.coordinate_buffer([[1, 2], [3, 4]]))) == [2, 1, 4, 3]
+
+
+def test_ewkb():
+    point = geometry.point_ewkb(geometry.coordinate_buffer([[1.5, 2.5]]), 4326)
+    assert point == struct.pack("<BIIdd", 1, geometry.WKB_POINT | geometry.EWKB_SRID_FLAG, 4326, 1.5, 2.5)
+
+    ring = geometry.coordinate_buffer([[0, 0], [0, 1], [1, 1], [0, 0]])
+    multipolygon = geometry.multipolygon_ewkb([[ring], [ring]], 4326)
+    polygon = struct.pack("<BIII8d", 1, geometry.WKB_POLYGON, 1, 4, *ring)
+    assert multipolygon == struct.pack("<BIII", 1, geometry.WKB_MULTIPOLYGON | geometry.EWKB_SRID_FLAG, 4326, 2) + polygon * 2
+
+
+def test_grid_cell():
+    assert geometry.grid_cell(43.655, -79.385, 0.01) == (4365, -7939)
+    assert geometry.cell_center((4365, -7939), 0.01) == pytest.approx((43.655, -79.385))
+
+
+def test_quantize_radius():
+    buckets = (0.5, 1, 2, 5)
+    assert geometry.quantize_radius(0.1, buckets) == 0.5
+    assert geometry.quantize_radius(1, buckets) == 1
+    assert geometry.quantize_radius(1.2, buckets) == 2
+    assert geometry.quantize_radius(6, buckets) is None
+
+
+def test_parse_wkt_polygon():
+    polygons = geometry.parse_wkt_polygon("POLYGON((0 0, 10 0, 10 10, 0 10, 0 0), (4 4, 6 4, 6 6, 4 6, 4 4))", 10)
+    assert [[list(ring) for ring in polygon] for polygon in polygons] == [[
+        [0, 0, 10, 0, 10, 10, 0, 10, 0, 0],
+        [4, 4, 6, 4, 6, 6, 4, 6, 4, 4]
+    ]]
+    assert geometry.polygons_area(polygons) == 96
+    assert geometry.polygons_bounding_box(polygons) == (0, 0, 10, 10)
+
+    polygons = geometry.parse_wkt_polygon("multipolygon (((0 0,1 0,1 1,0 0)),((20 0,30 0,25 10,20 0)))", 10)
+    assert len(polygons) == 2
+    assert geometry.polygons_area(polygons) == 50.5
+    assert geometry.polygons_bounding_box(polygons) == (0, 0, 30, 10)
+
+
+@pytest.mark.parametrize("polygon_string", [
+    None,
+    "",
+    "POINT(1 1)",
+    "POLYGON(0 0, 1 0, 1 1, 0 0)",
+    "POLYGON((0 0, 1 0, 1 1, 0 0)",
+    "POLYGON((0 0, 1 0, 1 1, 0 0)) x",
+    "POLYGON(((0 0, 1 0, 1 1, 0 0)))",
+    "POLYGON((0 0, 1 0, 1 1, 0 1))",
+    "POLYGON((0 0, 1 0, 0 0))",
+    "POLYGON((0 0, 1 a, 1 1, 0 0))",
+    "POLYGON((0 0, 1 nan, 1 1, 0 0))",
+    "POLYGON((0 0 0, 1 0 0, 1 1 0, 0 0 0))",
+    "POLYGON((0 0, 1 0, 1 1, 0 1, 0 0), (0 0, 1 0, 1 1, 0 1, 0 0))",
+    "POLYGON((" + "0 0, " * 100 + "0 0))"
+])
+def test_parse_wkt_polygon_invalid(polygon_string):
+    with pytest.raises(geometry.InvalidPolygon):
+        geometry.parse_wkt_polygon(polygon_string, 8)
+
+
+@patch("app.geometry.current_app")
+def test_search_shape(mock_current_app):
+    mock_current_app.config = {
+        "POLYGON_MAX_VERTICES": 10,
+        "POLYGON_MAX_AREA": 1.0,
+        "POLYGON_SIMPLIFY_VERTICES": 5,
+        "POLYGON_SIMPLIFY_TOLERANCE": 0.0001
+    }
+
+    shape, box = geometry.search_shape("POLYGON((0 0, 0.5 0, 0.5 0.5, 0 0))")
+    assert shape.name == "ST_GeomFromEWKB"
+    assert box.name == "ST_MakeEnvelope"
+
+    # large polygons are simplified
+    shape, box = geometry.search_shape("POLYGON((0 0, 0.5 0, 0.5 0.5, 0.4 0.5, 0.2 0.5, 0 0))")
+    assert shape.name == "ST_SimplifyPreserveTopology"
+
+    with pytest.raises(geometry.InvalidPolygon):
+        geometry.search_shape("POLYGON((0 0, 2 0, 2 2, 0 0))")
+    assert geometry.search_shape("POLYGON((0 0, 2 0, 2 2, 0 0))", limit_area=False)
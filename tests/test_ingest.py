@@ -0,0 +1,72 @@
+import os
+
+from unittest import mock
+
+from sqlalchemy.dialects import postgresql
+
+from app import ingest
+from app.models import community, community_resource
+from app.models.community import Community
+
+DB_INFO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "db_info")
+
+
+def test_bulk_upsert():
+    rows = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}, {"id": 1, "name": "c"}, {"id": 3, "name": "d"}]
+
+    with mock.patch("app.ingest.db.session") as session:
+        assert ingest.bulk_upsert(Community.__table__, iter(rows), "id", batch_size=2) == 3
+
+    # Two batches, the duplicate id skipped
+    assert session.execute.call_count == 2
+    statement = str(session.execute.call_args_list[0][0][0].compile(dialect=postgresql.dialect()))
+    assert "ON CONFLICT (id) DO UPDATE SET" in statement
+    assert "name = excluded.name" in statement
+    assert "id = excluded.id" not in statement
+
+
+def test_read_shapefile():
+    timer = ingest.IngestTimer("test")
+    communities = list(ingest.read_shapefile(
+        os.path.join(DB_INFO, "communities", "NEIGHBORHOODS_WGS84.shp"), community._parse_record, batch_size=50, timer=timer))
+    assert len(communities) == 140
+    assert timer.read == 140
+    assert all(isinstance(row["id"], int) for row in communities)
+
+    path = os.path.join(DB_INFO, "shelters", "shelters_wgs84.shp")
+    resources = list(ingest.read_shapefile(path, community_resource._parse_record))
+    assert len(resources) > 0
+    assert resources[0]["community_resource_id"] == resources[0]["charity_number"]
+    # Parsing in worker processes gives the same rows in the same order
+    assert list(ingest.read_shapefile(path, community_resource._parse_record, batch_size=10, workers=2)) == resources
+
+    assert list(ingest.read_shapefile(os.path.join(DB_INFO, "missing.shp"), community_resource._parse_record)) == []
+
+
+def test_file_checksum():
+    checksum = ingest.file_checksum(os.path.join(DB_INFO, "shelters", "shelters_wgs84.shp"))
+    assert len(checksum) == 64
+    assert checksum == ingest.file_checksum(os.path.join(DB_INFO, "shelters", "shelters_wgs84.shp"))
+    assert checksum != ingest.file_checksum(os.path.join(DB_INFO, "dropins", "TDIN_wgs84.shp"))
+    assert ingest.file_checksum(os.path.join(DB_INFO, "missing.shp")) is None
+
+
+def test_sync_records():
+    unchanged = {"id": 1, "name": "a"}
+    stored = {
+        "1": ingest.record_checksum(unchanged),
+        "2": ingest.record_checksum({"id": 2, "name": "b"}),
+        "3": ingest.record_checksum({"id": 3, "name": "c"})
+    }
+    rows = [unchanged, {"id": 2, "name": "changed"}, {"id": 4, "name": "d"}, {"id": 4, "name": "duplicate"}]
+
+    with mock.patch("app.ingest.SourceRecord") as source_record, mock.patch("app.ingest.db.session") as session:
+        source_record.get_checksums.return_value = stored
+        result = ingest.sync_records("community", Community.__table__, "id", iter(rows))
+
+    assert result.upserted == [2, 4]
+    assert result.deleted == [3]
+    assert set(source_record.set_checksums.call_args[0][1]) == {"2", "4"}
+    source_record.delete_keys.assert_called_once_with("community", ["3"])
+    # One upsert and one delete
+    assert session.execute.call_count == 2
@@ -0,0 +1,75 @@
+import asyncore
+import smtpd
+import threading
+
+from unittest.mock import patch
+
+from app import create_app, mailer
+from app.models.outbox_email import OutboxEmail
+
+
+class SinkServer(smtpd.SMTPServer):
+    """A local SMTP server which keeps the messages it receives."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None, decode_data=True)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.connections = 0
+
+    def handle_accepted(self, conn, addr):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accepted(self, conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+        self.messages.append((rcpttos, data))
+
+
+def run_sink():
+    server = SinkServer()
+    thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.05})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def test_retry_delay():
+    assert mailer.retry_delay(1, 30, 3600) == 30
+    assert mailer.retry_delay(2, 30, 3600) == 60
+    assert mailer.retry_delay(10, 30, 3600) == 3600
+
+
+@patch("app.mailer.db.session")
+@patch("app.mailer.OutboxEmail.claim_due")
+def test_send_due(mock_claim_due, mock_session):
+    server = run_sink()
+    app = create_app("testing").app
+    app.config.update(MAIL_SERVER="127.0.0.1", MAIL_PORT=server.port, MAIL_SMTP_POOL_SIZE=1)
+
+    emails = [OutboxEmail(recipient="user{}@example.com".format(i), subject="Hello", body="Hi", attempts=0) for i in range(3)]
+    unreachable = OutboxEmail(recipient="user@example.com", subject="Hello", body="Hi", attempts=0)
+
+    with app.app_context():
+        pool = mailer.SMTPPool.from_config(app.config)
+        mock_claim_due.side_effect = [emails, []]
+        assert mailer.send_due(pool) == 3
+        pool.close()
+
+        # Sent over one reused connection
+        assert [rcpttos for (rcpttos, data) in server.messages] == [["user0@example.com"], ["user1@example.com"], ["user2@example.com"]]
+        assert server.connections == 1
+        assert all(email.sent_at is not None and email.next_attempt_at is None for email in emails)
+
+        # Failures are retried with backoff, then given up on
+        server.close()
+        mock_claim_due.side_effect = [[unreachable], []]
+        mailer.send_due(pool)
+        assert unreachable.attempts == 1
+        assert unreachable.sent_at is None
+        assert unreachable.next_attempt_at is not None
+
+        unreachable.attempts = app.config["MAIL_MAX_ATTEMPTS"] - 1
+        mock_claim_due.side_effect = [[unreachable], []]
+        mailer.send_due(pool)
+        assert unreachable.next_attempt_at is None
+        assert unreachable.last_error is not None
@@ -1,7 +1,18 @@
+import json
+
+import jwt
 import pytest
 from unittest.mock import patch
 
 import app.models as models
+from app import create_app
+from app.geocoders import normalize_address
+from app.geometry import BoundingBoxTree, PreparedMultiPolygon
+from app.models.community import Community
+from app.models.community_resource import CommunityResource
+from app.models.geocode_cache import GeocodeCache, geocode_stats
+from app.models.resource_cluster import ResourceCluster
+from app.models.simplified_boundaries import select_tolerance, FULL_RESOLUTION, SIMPLIFICATION_TIERS
 
 
 @patch("flask_sqlalchemy.SignallingSession", autospec=True)
@@ -46,3 +57,179 @@ def test_user_token(mock_session, mock_current_app, mock_query):
     user_ = models.user.User.verify_auth_token(token)
     # different key
     assert user_ is None
+
+
+@patch("app.models.user.db.session")
+def test_user_password_rehash(mock_session):
+    app = create_app("testing").app
+    app.config["PASSWORD_HASH_ITERATIONS"] = 1000
+
+    with app.app_context():
+        user = models.user.User(user_id=1, email="foo")
+        user.password = "bar"
+        assert user.password_hash.startswith("pbkdf2:sha256:1000$")
+        assert not user.password_needs_rehash()
+
+        # outdated hashes are upgraded on a successful login
+        app.config["PASSWORD_HASH_ITERATIONS"] = 2000
+        assert user.password_needs_rehash()
+        assert not user.verify_password("baz")
+        assert user.password_hash.startswith("pbkdf2:sha256:1000$")
+        assert user.verify_password("bar")
+        assert user.password_hash.startswith("pbkdf2:sha256:2000$")
+        mock_session.commit.assert_called_once_with()
+        assert user.verify_password("bar")
+
+
+@patch("app.models.user.invalidate")
+@patch("app.models.user._token_versions")
+@patch("app.models.user.current_app")
+@patch("flask_sqlalchemy.SignallingSession", autospec=True)
+def test_user_token_claims(mock_session, mock_current_app, mock_token_versions, mock_invalidate):
+    user = models.user.User(user_id=1, email="foo", role=models.user.USER_ROLE_ADMIN, token_version=0)
+    mock_current_app.config = {"SECRET_KEY": "secret-key"}
+    mock_token_versions.get.return_value = {}
+    token = user.generate_auth_token()
+
+    # claims are read from the token alone
+    claims = models.user.User.get_claims_by_token(token)
+    assert claims["user_id"] == 1
+    assert claims["role"] == models.user.USER_ROLE_ADMIN
+    # incorrect token
+    assert models.user.User.get_claims_by_token("afdlkjsls;kfd") is None
+    # correctly signed tokens without the user's claims, like activation hashes
+    email_hash = jwt.encode({"email": "foo"}, "secret-key", algorithm="HS256").decode("utf-8")
+    assert models.user.User.get_claims_by_token(email_hash) is None
+
+    # revoked token
+    user.revoke_tokens()
+    mock_invalidate.assert_called_once_with(models.user.USER_DATA_VERSION)
+    mock_token_versions.get.return_value = {1: user.token_version}
+    assert models.user.User.get_claims_by_token(token) is None
+    # tokens issued after revocation are valid
+    assert models.user.User.get_claims_by_token(user.generate_auth_token())["user_id"] == 1
+
+
+def test_user_import_row_validation():
+    is_valid = models.user.User._is_valid_import_row
+
+    assert is_valid({"email": "a@example.com", "password": "bar"})
+    assert is_valid({"email": " a@example.com ", "password": "bar", "role": models.user.USER_ROLE_ADMIN})
+    assert is_valid({"email": "a@example.com", "password": "bar", "role": ""})
+    # invalid emails, missing passwords and unknown roles are skipped
+    assert not is_valid({"email": "invalid", "password": "bar"})
+    assert not is_valid({"password": "bar"})
+    assert not is_valid({"email": "a@example.com", "password": ""})
+    assert not is_valid({"email": "a@example.com"})
+    assert not is_valid({"email": "a@example.com", "password": "bar", "role": "superuser"})
+
+
+def test_select_tolerance():
+    coarsest = SIMPLIFICATION_TIERS[0][1]
+    finest = SIMPLIFICATION_TIERS[-1][1]
+
+    # no preference
+    assert select_tolerance() == FULL_RESOLUTION
+    # zoomed out
+    assert select_tolerance(zoom=0) == coarsest
+    # zoomed in
+    assert select_tolerance(zoom=SIMPLIFICATION_TIERS[-1][0]) == finest
+    assert select_tolerance(zoom=22) == FULL_RESOLUTION
+    # tolerance is an upper bound
+    assert select_tolerance(tolerance=1) == coarsest
+    assert select_tolerance(tolerance=finest) == finest
+    assert select_tolerance(tolerance=finest / 2) == FULL_RESOLUTION
+    # zoom takes precedence
+    assert select_tolerance(zoom=22, tolerance=1) == FULL_RESOLUTION
+
+
+@patch("app.models.community._community_index")
+def test_get_community_surrounding_unsimplified(mock_community_index):
+    polygon = PreparedMultiPolygon([[[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]]])
+    community = Community(id=1, name="Unsimplified")
+    mock_community_index.get.return_value = BoundingBoxTree([(polygon.box, (community, {FULL_RESOLUTION: "full"}, polygon))])
+
+    # communities without simplified boundaries are sent at full resolution
+    assert Community.get_community_surrounding(5, 5, 0.001) == (community, "full")
+    assert Community.get_community_surrounding(20, 20, 0.001) is None
+
+
+def test_resource_cluster_to_dict():
+    resource_cluster = ResourceCluster(zoom=10, cell_x=1, cell_y=2, count=4, sum_x=2.0, sum_y=-6.0)
+
+    assert resource_cluster.to_dict() == {
+        "count": 4,
+        "location": {"type": "Point", "coordinates": [0.5, -1.5]}
+    }
+
+
+@patch("app.models.resource_cluster.db.session")
+def test_resource_cluster_remove_resource(mock_session):
+    ResourceCluster.add_resource(5)
+    assert mock_session.execute.call_count == 1
+
+    # emptied cells are deleted, looking only at the resource's own cells
+    ResourceCluster.add_resource(5, -1)
+    statement, params = mock_session.execute.call_args[0]
+    assert statement.startswith("DELETE FROM resource_clusters WHERE count <= 0 AND (zoom, cell_x, cell_y) IN")
+    assert "WHERE community_resource_id = :community_resource_id" in statement
+    assert params["community_resource_id"] == 5
+
+
+@patch("app.models.community_resource._search_cells")
+@patch("app.models.community_resource.current_app")
+def test_get_resources_by_radius_quantized(mock_current_app, mock_search_cells):
+    mock_current_app.config = {"SEARCH_CELL_SIZE": 0.01}
+    mock_search_cells.get.side_effect = lambda key, load: [
+        ({"community_resource_id": 1, "name": "far"}, 43.664, -79.385),
+        ({"community_resource_id": 2, "name": "near"}, 43.656, -79.385)
+    ]
+
+    # coordinates are (latitude, longitude); the second resource is about 110m away
+    resources = json.loads(CommunityResource.get_resources_by_radius_quantized(43.655, -79.385, 1.2))
+    assert [resource["community_resource_id"] for resource in resources] == [2, 1]
+    assert resources[0]["distance"] == pytest.approx(0.111, abs=0.001)
+    # nearby searches share the cell and the rounded up radius
+    assert mock_search_cells.get.call_args[0][0] == ((4365, -7939), 2)
+
+    resources = json.loads(CommunityResource.get_resources_by_radius_quantized(43.6551, -79.3851, 0.5))
+    assert [resource["community_resource_id"] for resource in resources] == [2]
+    assert mock_search_cells.get.call_args[0][0] == ((4365, -7939), 0.5)
+
+
+def test_normalize_address():
+    assert normalize_address("1 Yonge St.") == "1 yonge st"
+    assert normalize_address("  1  YONGE st, Toronto ") == "1 yonge st toronto"
+    assert normalize_address("Unit #4, 1 Yonge St") == "unit 4 1 yonge st"
+
+
+@patch("app.models.geocode_cache.get_geocoder")
+@patch("app.models.geocode_cache.db.Model.query")
+@patch("app.models.geocode_cache.current_app")
+@patch("app.models.geocode_cache.GeocodeCache._store")
+def test_geocode_cache(mock_store, mock_current_app, mock_query, mock_get_geocoder):
+    mock_current_app.config = {"GEOCODE_CACHE_TTL": 60, "GEOCODE_NEGATIVE_CACHE_TTL": 60}
+    mock_query.get.return_value = None
+    mock_get_geocoder.return_value.geocode_many.side_effect = lambda addresses: [(-79.3, 43.6)] * len(addresses)
+    geocoder_lookups = geocode_stats["geocoder"]
+
+    # first lookup goes to the geocoder and is stored
+    assert GeocodeCache.geocode("123 Queen St. W") == (-79.3, 43.6)
+    assert geocode_stats["geocoder"] == geocoder_lookups + 1
+    assert mock_store.call_args[0][:2] == ("123 queen st w", (-79.3, 43.6))
+    # equivalent addresses are answered from memory
+    assert GeocodeCache.geocode("123 queen st w") == (-79.3, 43.6)
+    assert geocode_stats["geocoder"] == geocoder_lookups + 1
+
+    # addresses which cannot be geocoded are cached too
+    mock_get_geocoder.return_value.geocode_many.side_effect = lambda addresses: [None] * len(addresses)
+    assert GeocodeCache.geocode("nowhere") is None
+    assert GeocodeCache.geocode("Nowhere") is None
+    assert geocode_stats["geocoder"] == geocoder_lookups + 2
+
+    # batches look up each uncached address once, together
+    lookups = geocode_stats["geocoder"]
+    mock_get_geocoder.return_value.geocode_many.side_effect = lambda addresses: [(len(address), 0) for address in addresses]
+    assert GeocodeCache.geocode_many(["1 King St", "123 Queen St W", "1 king st.", "10 Bay St"]) == [(9, 0), (-79.3, 43.6), (9, 0), (9, 0)]
+    assert mock_get_geocoder.return_value.geocode_many.call_args[0][0] == ["1 King St", "10 Bay St"]
+    assert geocode_stats["geocoder"] == lookups + 2
@@ -0,0 +1,62 @@
+import json
+
+from unittest.mock import patch
+
+from connexion import NoContent
+
+from app import create_app, response_cache
+
+
+@patch("app.cache.DataVersion")
+def test_cached_response(mock_data_version):
+    app = create_app("testing").app
+    app.config["RESPONSE_CACHE_SHARED"] = "local"
+    mock_data_version.get_version.return_value = 0
+    calls = []
+
+    @response_cache.cached_response("test")
+    def get_things(thing_id):
+        calls.append(thing_id)
+        if thing_id == 0:
+            return NoContent, 404
+        return {"id": thing_id}, 200
+
+    cache = response_cache.response_caches["get_things"]
+
+    with app.test_request_context("/?b=2&a=1"):
+        rv = get_things(thing_id=1)
+        assert rv.status_code == 200
+        assert json.loads(rv.get_data(as_text=True)) == {"id": 1}
+        assert "ETag" in rv.headers
+
+    # The same parameters in another order are a hit
+    with app.test_request_context("/?a=1&b=2"):
+        assert json.loads(get_things(thing_id=1).get_data(as_text=True)) == {"id": 1}
+    assert calls == [1]
+
+    # Other parameters are a miss
+    with app.test_request_context("/?a=1&b=3"):
+        get_things(thing_id=1)
+    assert calls == [1, 1]
+
+    # Unsuccessful responses are not cached
+    with app.test_request_context("/"):
+        assert get_things(thing_id=0) == (NoContent, 404)
+        assert get_things(thing_id=0) == (NoContent, 404)
+    assert calls == [1, 1, 0, 0]
+
+    # Another process finds the response in the shared tier
+    cache.local.clear()
+    with app.test_request_context("/?a=1&b=2"):
+        get_things(thing_id=1)
+    assert calls == [1, 1, 0, 0]
+    assert cache.stats()["shared_hits"] == 1
+
+    # Writes to the dataset discard the response from both tiers
+    mock_data_version.get_version.return_value = 1
+    with app.test_request_context("/?a=1&b=2"):
+        get_things(thing_id=1)
+    assert calls == [1, 1, 0, 0, 1]
+
+    assert cache.stats()["hits"] == 1
+    assert set(cache.stats()) == {"size", "hits", "misses", "shared_hits", "shared_misses", "coalesced", "timeouts"}
@@ -0,0 +1,31 @@
+from app import tiles
+
+
+def test_tile_bounds():
+    extent = tiles.WEB_MERCATOR_EXTENT
+
+    # The whole world
+    assert tiles.tile_bounds(0, 0, 0) == (-extent, -extent, extent, extent)
+    # The north west quarter
+    assert tiles.tile_bounds(1, 0, 0) == (-extent, 0, 0, extent)
+    # The south east quarter
+    assert tiles.tile_bounds(1, 1, 1) == (0, -extent, extent, 0)
+
+
+def test_is_valid_tile():
+    assert tiles.is_valid_tile(0, 0, 0)
+    assert tiles.is_valid_tile(12, 1144, 1494)
+    # Out of range for the zoom level
+    assert not tiles.is_valid_tile(1, 2, 0)
+    assert not tiles.is_valid_tile(1, 0, 2)
+    # Zoom level too deep
+    assert not tiles.is_valid_tile(tiles.MAX_ZOOM + 1, 0, 0)
+
+
+def test_tile_containing():
+    assert tiles.tile_containing(0, -79.39806, 43.70649) == (0, 0)
+    # The tile used by the resource tile tests
+    assert tiles.tile_containing(12, -79.39806, 43.70649) == (1144, 1494)
+    # The corners of the world
+    assert tiles.tile_containing(1, -180, 85) == (0, 0)
+    assert tiles.tile_containing(1, 180, -85) == (1, 1)